@@ -1,11 +1,29 @@
 #!/usr/bin/env python3
 
+import sys
 from aws_cdk import App
 from core.monorepo_stack import MonorepoStack
 from core.pipelines_stack import PipelineStack
+from core.pipeline_registry import (DEFAULT_FINGERPRINT_CACHE, FingerprintCache, collect_service_map, fingerprint,
+                                   pipeline_stack_name, shard_service_map)
+import monorepo_config
 
 app = App()
 core = MonorepoStack(app, "MonoRepoStack")
-PipelineStack(app, "PipelinesStack", core.exported_monorepo)
+
+# Pipelines split across several stacks, e.g. cdk synth -c pipelineShards=8 (PipelinesStack-0 ... PipelinesStack-7)
+pipeline_shards = int(app.node.try_get_context('pipelineShards') or 1)
+# Skip the pipeline stacks whose definitions did not change since the fingerprints recorded after the last
+# deployment (make record-pipeline-fingerprints), synth only reads them
+only_changed = str(app.node.try_get_context('onlyChangedPipelines') or 'false').lower() == 'true'
+fingerprint_cache = FingerprintCache(app.node.try_get_context('pipelineCache') or DEFAULT_FINGERPRINT_CACHE)
+
+service_map = collect_service_map(monorepo_config.service_map)
+for shard, shard_map in enumerate(shard_service_map(service_map, pipeline_shards)):
+    stack_name = pipeline_stack_name(shard, pipeline_shards)
+    if only_changed and fingerprint_cache.is_unchanged(stack_name, fingerprint(shard_map)):
+        print(f'{stack_name} unchanged, skipped', file=sys.stderr)
+        continue
+    PipelineStack(app, stack_name, core.exported_monorepo, service_map=shard_map)
 
 app.synth()
@@ -9,6 +9,19 @@ class ServicePipeline(ABC):
     def pipeline_name(self) -> str:
         pass
 
+    def priority(self) -> int:
+        """
+        Start priority of the pipeline when the trigger has a start budget: higher priorities are started first
+        and lower ones are queued before them (e.g. 100 for a hotfix pipeline)
+        """
+        return 0
+
+    def weight(self) -> int:
+        """
+        Share of the start budget taken by a running execution of the pipeline (e.g. its number of CodeBuild builds)
+        """
+        return 1
+
     @abstractmethod
     def build_pipeline(self, scope: Construct, code_commit: codecommit.Repository, pipeline_name: str, service_name: str):
-        pass
\ No newline at end of file
+        pass
@@ -0,0 +1,9 @@
+"""
+Synth-side access to the artifact helper of the trigger lambda (core/lambda/artifacts.py). core/lambda is not a
+package name ('lambda' is a keyword), so the helper is imported by its module path, once, here.
+"""
+from importlib import import_module
+
+_artifacts = import_module('core.lambda.artifacts')
+read_artifact = _artifacts.read_artifact
+write_artifact = _artifacts.write_artifact
@@ -0,0 +1,33 @@
+"""
+Compiles monorepo_config.service_dependencies into the dependency graph artifact read by the trigger lambda
+(core/lambda/dependency_graph.py): the reverse adjacency, directory -> directories that depend on it directly.
+"""
+from typing import Dict, List
+
+ARTIFACT_NAME = 'dependency-graph.json'
+ARTIFACT_VERSION = 1
+ARTIFACT_KEY = 'dependents'
+
+
+def normalize_dir(dirname: str) -> str:
+    if not isinstance(dirname, str) or not dirname.strip('/'):
+        raise ValueError(f'invalid directory in service_dependencies: {dirname!r}')
+    if set('*?[').intersection(dirname):
+        raise ValueError(f'patterns are not supported in service_dependencies: {dirname!r}')
+    return dirname.strip('/')
+
+
+def compile_dependents(service_dependencies: Dict[str, List[str]]) -> dict:
+    """
+    Returns {directory: sorted directories depending on it directly}, self dependencies are dropped
+    """
+    dependents = {}
+    for dirname, dependencies in service_dependencies.items():
+        dirname = normalize_dir(dirname)
+        if isinstance(dependencies, str):
+            dependencies = [dependencies]
+        for dependency in dependencies:
+            dependency = normalize_dir(dependency)
+            if dependency != dirname:
+                dependents.setdefault(dependency, set()).add(dirname)
+    return {dependency: sorted(dependents[dependency]) for dependency in sorted(dependents)}
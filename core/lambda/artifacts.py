@@ -0,0 +1,34 @@
+"""
+Versioned JSON artifacts compiled from monorepo_config at synth time and bundled with the lambda code:
+    {"version": 1, "<key>": payload}
+Compiled by core/routing_artifact.py, core/dependency_graph.py and core/pipeline_schedule.py and written by
+MonoRepoStack (through core/artifacts.py), read by the router, the dependency graph and the pipeline schedule of
+the trigger. Only the standard library is imported, so that synth loads this module from core/lambda as well.
+"""
+import json
+import os
+
+
+def write_artifact(directory: str, name: str, version: int, key: str, payload) -> str:
+    """
+    Writes the artifact name in directory (compact JSON, sorted keys) and returns its path
+    """
+    path = os.path.join(directory, name)
+    with open(path, 'w') as artifact:
+        json.dump({'version': version, key: payload}, artifact, separators=(',', ':'), sort_keys=True)
+    return path
+
+
+def read_artifact(path: str, version: int, key: str, kind: str):
+    """
+    Returns the payload of an artifact, None when the file does not exist.
+    Raises ValueError when the artifact has another version than the code reading it.
+    """
+    try:
+        with open(path) as artifact:
+            content = json.load(artifact)
+    except FileNotFoundError:
+        return None
+    if content.get('version') != version:
+        raise ValueError(f"{path}: unsupported {kind} version {content.get('version')}")
+    return content[key]
@@ -0,0 +1,21 @@
+"""
+Memo caches of the trigger keyed by directory (pipeline router, dependency graph). A large diff touches many
+directories and the caches live across warm invocations, so their size is capped.
+"""
+DIR_CACHE_SIZE = 65536
+
+
+class BoundedCache(dict):
+    """
+    A dict emptied when a new key is added while it holds max_size entries, so that its memory stays bounded.
+    Reads are plain dict reads.
+    """
+
+    def __init__(self, max_size: int = DIR_CACHE_SIZE):
+        super().__init__()
+        self.max_size = max_size
+
+    def __setitem__(self, key, value):
+        if len(self) >= self.max_size and key not in self:
+            self.clear()
+        super().__setitem__(key, value)
@@ -0,0 +1,263 @@
+"""
+Catch-up of the trigger after an outage: failed invocations, messages in the dead-letter queues, or a backlog too
+large for a single run. Each branch is brought from its LastCommit up to its head in chunks of first-parent commits,
+with the functions of the trigger (handler.py), LastCommit being advanced after each chunk.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import time
+
+from handler import (BRANCH_WORKERS, collect_matched_rules, get_client, get_last_commit_store, get_parent_commit,
+                     get_references, get_stored_last_commit, record_cold_start, resolve_pipeline_names,
+                     trigger_pipelines, update_last_commit)
+from last_commit_store import LastCommitConflict, SsmLastCommitStore
+from metrics import InvocationMetrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# First-parent commits diffed per chunk, walked back towards LastCommit at most per plan, time kept when a chunk is
+# started, and dead-letter queues drained (comma separated URLs)
+CATCH_UP_CHUNK_COMMITS = int(os.environ.get('CATCH_UP_CHUNK_COMMITS', '50'))
+CATCH_UP_MAX_COMMITS = int(os.environ.get('CATCH_UP_MAX_COMMITS', '2000'))
+CATCH_UP_RESERVED_MS = int(os.environ.get('CATCH_UP_RESERVED_MS', '60000'))
+CATCH_UP_VISIBILITY_TIMEOUT = int(os.environ.get('CATCH_UP_VISIBILITY_TIMEOUT', '900'))
+DEAD_LETTER_QUEUE_URLS = [url for url in os.environ.get('DEAD_LETTER_QUEUE_URLS', '').split(',') if url]
+
+
+def catch_up(event, context):
+    """
+    This AWS Lambda is invoked manually (or on schedule) to recover after an outage: failed invocations,
+    messages in the dead-letter queues, or a backlog too large for a single run. It brings each branch from its
+    LastCommit up to its head (or the given commit), in chunks of CATCH_UP_CHUNK_COMMITS first-parent commits:
+    every chunk advances LastCommit (the checkpoint) and each pipeline is started once, with its first chunk.
+        {"references": [{"repository": "monorepo-sample", "branch": "main"}], "drain_dead_letters": true}
+    The branches of the messages of DEAD_LETTER_QUEUE_URLS are caught up as well, their messages are deleted
+    once the branch is complete. No chunk is started within CATCH_UP_RESERVED_MS of the timeout: the result then
+    lists the partial branches as 'references', to invoke catch_up with again.
+    catch_up advances LastCommit outside of the message groups of the trigger queue, so it requires a last commit
+    store with atomic compare-and-swap (DynamoDB).
+    """
+    record_cold_start('catch_up')
+    if isinstance(get_last_commit_store(), SsmLastCommitStore):
+        raise ValueError('catch-up requires the dynamodb last commit store (-c lastCommitStore=dynamodb)')
+    deadline = get_deadline(context)
+    references = {(reference['repository'], reference['branch']): reference
+                  for reference in event.get('references', ())}
+    results = {}
+    drained = 0
+    while True:
+        dead_letters = receive_dead_letters() if event.get('drain_dead_letters', True) else {}
+        for key, dead_letter in dead_letters.items():
+            if key is None:
+                continue
+            reference = references.setdefault(key, {'repository': key[0], 'branch': key[1]})
+            reference['pipelines'] = [*reference.get('pipelines', ()), *dead_letter['pipelines']]
+        if references:
+            results.update(catch_up_references(list(references.values()), deadline))
+        drained += delete_dead_letters(dead_letters, results)
+        references = {}
+        if not dead_letters or is_past(deadline):
+            break
+
+    partial = [{'repository': result['repository'], 'branch': result['branch'], 'commit': result['commit'],
+                'started': result['started'], 'targets': result['targets']}
+               for result in results.values() if result['status'] == 'partial']
+    logger.info('catch-up: %s, dead letters deleted: %d', {key: result['status'] for key, result in results.items()},
+                drained)
+    return {'branches': results, 'dead_letters_deleted': drained, 'references': partial}
+
+
+def catch_up_references(references, deadline=None):
+    """
+    catch_up_branch each reference concurrently, returns {'repository/branch_name': result}
+    """
+    workers = max(1, min(BRANCH_WORKERS, len(references)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {f"{reference['repository']}/{reference['branch']}": executor.submit(
+            catch_up_branch, reference['repository'], reference['branch'], reference.get('commit'),
+            reference.get('started', ()), reference.get('pipelines', ()), deadline, reference.get('targets', ()))
+            for reference in references}
+    return {key: future.result() for key, future in futures.items()}
+
+
+def catch_up_branch(repository, branch_name, commit_id=None, started=(), pipelines=(), deadline=None, targets=()):
+    """
+    Catch a branch up from its LastCommit to commit_id (its head by default), chunk by chunk.
+    started are the pipelines already started by a previous partial run, pipelines are started in any case
+    (deferred starts found in a dead-letter queue).
+    When LastCommit is not found within CATCH_UP_MAX_COMMITS first parents, the oldest commit walked is pushed on
+    targets, the checkpoints of the walk: the branch is first caught up to the last target, then to the previous
+    ones, so no range longer than the walk is ever diffed at once.
+    Returns {'status': 'complete' | 'partial' | 'conflict' | 'failed', 'commit', 'last_commit', 'chunks', 'started',
+    'targets'}: 'conflict' when another invocation advanced LastCommit meanwhile, 'failed' when a chunk raised.
+    """
+    metrics = InvocationMetrics(Repository=repository)
+    metrics.set_property('Branch', branch_name)
+    metrics.set_property('EntryPoint', 'catch_up')
+    started = set(started)
+    targets = list(targets)
+    result = {'repository': repository, 'branch': branch_name, 'commit': commit_id, 'status': 'complete',
+              'chunks': 0, 'targets': targets}
+    try:
+        with metrics.phase('Total'):
+            with metrics.phase('LastCommit'):
+                commit_id = result['commit'] = commit_id or get_branch_head(repository, branch_name)
+                metrics.set_property('Commit', commit_id)
+                expected_commit = result['last_commit'] = get_stored_last_commit(repository, branch_name)
+            pending = [name for name in dict.fromkeys(pipelines) if name not in started]
+            if pending:
+                trigger_pipelines(repository, branch_name, commit_id, pending, metrics)
+                started.update(pending)
+
+            while result['status'] == 'complete':
+                target = targets[-1] if targets else commit_id
+                with metrics.phase('Walk'):
+                    chunks, oldest_commit = plan_catch_up_chunks(repository, target, expected_commit, deadline)
+                if chunks is None:
+                    if oldest_commit in (None, target):
+                        result['status'] = 'partial'
+                    else:
+                        targets.append(oldest_commit)
+                    continue
+                metrics.put('CatchUpCommitsPlanned', len(chunks))
+                for chunk_start, chunk_end in chunks:
+                    if is_past(deadline):
+                        result['status'] = 'partial'
+                        break
+                    with metrics.phase('Diff'):
+                        matched_rules, router = collect_matched_rules(repository, chunk_end, branch_name,
+                                                                      chunk_start, metrics=metrics)
+                    names = [name for name in resolve_pipeline_names(matched_rules, router) if name not in started]
+                    logger.info('catch-up chunk %s..%s (%s): %s', chunk_start, chunk_end, branch_name, names)
+                    trigger_pipelines(repository, branch_name, commit_id, names, metrics)
+                    started.update(names)
+                    with metrics.phase('UpdateLastCommit'):
+                        update_last_commit(repository, chunk_end, branch_name, expected_commit)
+                    expected_commit = result['last_commit'] = chunk_end
+                    result['chunks'] += 1
+                else:
+                    if not targets:
+                        break
+                    targets.pop()
+    except LastCommitConflict as e:
+        logger.warning('catch-up of %s/%s stopped: %s', repository, branch_name, e)
+        result['status'] = 'conflict'
+    except Exception as e:
+        logger.exception('catch-up of %s/%s failed', repository, branch_name)
+        metrics.put('Errors', 1)
+        result.update(status='failed', error=str(e))
+    finally:
+        metrics.put('CatchUpChunks', result['chunks'])
+        metrics.put('PipelinesStartedTotal', len(started))
+        metrics.flush()
+    result['started'] = sorted(started)
+    return result
+
+
+def plan_catch_up_chunks(repository, commit_id, last_commit, deadline=None):
+    """
+    Returns (chunks, None): the (before, after) commit ranges from last_commit to commit_id, of CATCH_UP_CHUNK_COMMITS
+    first-parent commits each, oldest first (one GetCommit per commit walked). The range is a single chunk when
+    last_commit is unknown.
+    Returns (None, oldest commit walked) when last_commit is not found within CATCH_UP_MAX_COMMITS first parents, or
+    before the deadline: the walk is resumed from that commit. Raises ValueError when last_commit is not a
+    first-parent ancestor of commit_id (rewritten history): LastCommit has to be reset.
+    """
+    if last_commit == commit_id:
+        return [], None
+    if last_commit is None:
+        return [(get_parent_commit(repository, commit_id), commit_id)], None
+    commits = []
+    commit = commit_id
+    while commit != last_commit:
+        if commit is None:
+            raise ValueError(f'{last_commit} is not a first-parent ancestor of {commit_id}')
+        if len(commits) >= CATCH_UP_MAX_COMMITS or is_past(deadline):
+            logger.info('%s not found within %d first parents of %s, walk resumed from %s',
+                        last_commit, len(commits), commit_id, commits[-1] if commits else commit_id)
+            return None, commits[-1] if commits else None
+        commits.append(commit)
+        commit = get_parent_commit(repository, commit)
+
+    commits.reverse()
+    boundaries = commits[CATCH_UP_CHUNK_COMMITS - 1::CATCH_UP_CHUNK_COMMITS]
+    if not boundaries or boundaries[-1] != commit_id:
+        boundaries.append(commit_id)
+    return list(zip([last_commit, *boundaries], boundaries)), None
+
+
+def get_branch_head(repository, branch_name):
+    return get_client('codecommit').get_branch(repositoryName=repository, branchName=branch_name)['branch']['commitId']
+
+
+def get_deadline(context):
+    """
+    perf_counter time after which no catch-up chunk is started, None without a Lambda context
+    """
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return time.perf_counter() + (context.get_remaining_time_in_millis() - CATCH_UP_RESERVED_MS) / 1000
+
+
+def is_past(deadline):
+    return deadline is not None and time.perf_counter() >= deadline
+
+
+def receive_dead_letters(queue_urls=None):
+    """
+    Receive the messages of the dead-letter queues (hidden for CATCH_UP_VISIBILITY_TIMEOUT) and group them by branch:
+    {(repository, branch_name): {'pipelines': [deferred pipelines], 'receipts': [(queue url, receipt handle)]}}.
+    A message is either a trigger queue message, or a CodeCommit event of a failed asynchronous invocation.
+    Messages without branch to process are listed under the None key.
+    A FIFO queue does not return the following messages of a group while some are received: they come
+    with the next call, once the received ones are deleted.
+    """
+    sqs = get_client('sqs')
+    dead_letters = {}
+    for queue_url in queue_urls or DEAD_LETTER_QUEUE_URLS:
+        while True:
+            messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=0,
+                                           VisibilityTimeout=CATCH_UP_VISIBILITY_TIMEOUT).get('Messages', [])
+            if not messages:
+                break
+            for message in messages:
+                body = json.loads(message['Body'])
+                if 'Records' in body:
+                    keys = [(repository, branch_name) for repository, branch_name, _ in get_references(body)]
+                    pipelines = []
+                else:
+                    keys = [(body['repository'], body['branch'])]
+                    pipelines = body.get('pipelines') or []
+                for key in keys or [None]:
+                    dead_letter = dead_letters.setdefault(key, {'pipelines': [], 'receipts': []})
+                    dead_letter['pipelines'].extend(pipelines)
+                    dead_letter['receipts'].append((queue_url, message['ReceiptHandle']))
+    return dead_letters
+
+
+def delete_dead_letters(dead_letters, results):
+    """
+    Delete the dead letters of the branches caught up completely (and the ones without branch),
+    returns the number of messages deleted. A message of several branches is kept until all are complete.
+    """
+    receipts = {}
+    for key, dead_letter in dead_letters.items():
+        complete = key is None or results.get('/'.join(key), {}).get('status') == 'complete'
+        for receipt in dead_letter['receipts']:
+            receipts[receipt] = receipts.get(receipt, True) and complete
+
+    entries = {}
+    for (queue_url, receipt_handle), complete in receipts.items():
+        if complete:
+            entries.setdefault(queue_url, []).append(receipt_handle)
+    deleted = 0
+    for queue_url, receipt_handles in entries.items():
+        for start in range(0, len(receipt_handles), 10):
+            batch = [{'Id': str(index), 'ReceiptHandle': receipt_handle}
+                     for index, receipt_handle in enumerate(receipt_handles[start:start + 10])]
+            response = get_client('sqs').delete_message_batch(QueueUrl=queue_url, Entries=batch)
+            deleted += len(batch) - len(response.get('Failed', ()))
+    return deleted
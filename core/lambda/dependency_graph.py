@@ -0,0 +1,57 @@
+"""
+Dependency graph between the directories of the monorepo, compiled at synth time from
+monorepo_config.service_dependencies (see core/dependency_graph.py) and bundled with the lambda code.
+
+The artifact only holds the reverse adjacency, directory -> directories that depend on it directly:
+    {"version": 1, "dependents": {"libs/common": ["demo", "hotsite"], "demo": ["hotsite"]}}
+A modified directory impacts the dependents of itself and of each of its parent directories, transitively.
+"""
+from artifacts import read_artifact
+from bounded_cache import BoundedCache
+
+ARTIFACT_VERSION = 1
+
+
+class DependencyGraph:
+
+    def __init__(self, dependents: dict = None):
+        self.dependents = {dirname: tuple(directories) for dirname, directories in (dependents or {}).items()}
+        self._dir_cache = BoundedCache()
+
+    @classmethod
+    def load(cls, path: str) -> 'DependencyGraph':
+        """
+        Reads an artifact, a missing file is an empty graph
+        """
+        return cls(read_artifact(path, ARTIFACT_VERSION, 'dependents', 'dependency graph'))
+
+    def direct_dependents(self, dirname: str) -> tuple:
+        """
+        Directories depending on dirname or on one of its parent directories, memoized per directory
+        """
+        dependents = self._dir_cache.get(dirname)
+        if dependents is None:
+            segments = dirname.split('/')
+            dependents = tuple(dict.fromkeys(
+                dependent for depth in range(1, len(segments) + 1)
+                for dependent in self.dependents.get('/'.join(segments[:depth]), ())))
+            self._dir_cache[dirname] = dependents
+        return dependents
+
+    def impacted(self, dirnames) -> set:
+        """
+        Returns the directories transitively depending on the modified directories (each directory is
+        visited once, so cycles are harmless). The modified directories are not included
+        unless they depend on another modified directory.
+        """
+        impacted = set()
+        if not self.dependents:
+            return impacted
+        pending = [dependent for dirname in dirnames for dependent in self.direct_dependents(dirname)]
+        while pending:
+            dirname = pending.pop()
+            if dirname in impacted:
+                continue
+            impacted.add(dirname)
+            pending.extend(self.direct_dependents(dirname))
+        return impacted
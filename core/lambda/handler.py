@@ -1,106 +1,740 @@
+import time
+
+_INIT_STARTED_AT = time.perf_counter()
+
 import logging
-import base64
-import boto3
-import botocore
-from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+import hashlib
+import itertools
 import json
+import math
+import os
+import random
+import threading
+from metrics import InvocationMetrics, is_sampled
+from last_commit_store import LastCommitStore, SsmLastCommitStore, DynamoDbLastCommitStore, InMemoryLastCommitStore
+from pipeline_router import PipelineRouter, load_routing_artifact
+from dependency_graph import DependencyGraph
+from pipeline_scheduler import InFlightLedger, PipelineSchedule
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-codecommit = boto3.client('codecommit')
-ssm = boto3.client('ssm')
+# AWS clients are created on first use (boto3 is only imported then) and reused across warm invocations.
+# Assign _clients[service_name] to provide another client (stubs, local emulators).
+_clients = {}
+_clients_lock = threading.Lock()
+_cold_start = {'client_init_ms': 0.0}
+last_commit_store = None
+
+
+def get_client(service_name):
+    """
+    Returns the cached boto3 client of an AWS service, creating it on first use
+    """
+    client = _clients.get(service_name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(service_name)
+            if client is None:
+                started_at = time.perf_counter()
+                import boto3
+                client = _clients[service_name] = boto3.client(service_name)
+                _cold_start['client_init_ms'] += (time.perf_counter() - started_at) * 1000
+    return client
+
+
+def create_last_commit_store() -> LastCommitStore:
+    """
+    Backend selected by LAST_COMMIT_STORE: 'ssm' (default), 'dynamodb' (table LAST_COMMIT_TABLE) or 'memory'
+    """
+    backend = os.environ.get('LAST_COMMIT_STORE', 'ssm')
+    if backend == 'dynamodb':
+        return DynamoDbLastCommitStore(get_client('dynamodb'), os.environ['LAST_COMMIT_TABLE'])
+    if backend == 'memory':
+        return InMemoryLastCommitStore()
+    return SsmLastCommitStore(get_client('ssm'))
+
+
+def get_last_commit_store() -> LastCommitStore:
+    global last_commit_store
+    if last_commit_store is None:
+        last_commit_store = create_last_commit_store()
+    return last_commit_store
+
+
+def record_cold_start(entry_point):
+    """
+    Reports, on the first invocation of the container only, the time spent importing this module
+    and creating the AWS clients used so far
+    """
+    if 'init_duration_ms' in _cold_start:
+        return
+    _cold_start['init_duration_ms'] = round(_INIT_DURATION_MS, 2)
+    metrics = InvocationMetrics(EntryPoint=entry_point)
+    metrics.set_property('cold_start', True)
+    metrics.put('ColdStart', 1)
+    metrics.put('InitDurationMs', _cold_start['init_duration_ms'], 'Milliseconds')
+    metrics.put('ClientInitMs', round(_cold_start['client_init_ms'], 2), 'Milliseconds')
+    metrics.flush()
+
+
+# FIFO queue in front of the trigger, one message group per (repository, branch)
+TRIGGER_QUEUE_URL = os.environ.get('TRIGGER_QUEUE_URL')
+
+# Pushes to a branch within the window are coalesced into a single run (FIFO queue only)
+COALESCE_WINDOW_SECONDS = int(os.environ.get('COALESCE_WINDOW_SECONDS', '0'))
+MAX_VISIBILITY_TIMEOUT = 43200
+
+# Content-hash mode: rules whose files are byte-identical after the diff (mode-only changes) are not triggered
+CONTENT_HASH_MODE = os.environ.get('CONTENT_HASH_MODE', 'false').lower() == 'true'
+# Mersenne prime: a non-zero directory digest weighted by its path never vanishes
+DIGEST_MODULUS = (1 << 127) - 1
+
+# Pipelines already running (GetPipelineState): 'start' anyway, 'skip' the ones running the same commit, or also
+# 'defer' the ones running another commit until IN_PROGRESS_RETRY_SECONDS later (FIFO queue only)
+IN_PROGRESS_POLICY = os.environ.get('IN_PROGRESS_POLICY', 'start')
+IN_PROGRESS_RETRY_SECONDS = int(os.environ.get('IN_PROGRESS_RETRY_SECONDS', '60'))
+
+# Pipeline start fan-out: bounded thread pool and jittered retries on throttling
+PIPELINE_START_WORKERS = int(os.environ.get('PIPELINE_START_WORKERS', '10'))
+PIPELINE_START_MAX_ATTEMPTS = int(os.environ.get('PIPELINE_START_MAX_ATTEMPTS', '5'))
+PIPELINE_START_BASE_DELAY = float(os.environ.get('PIPELINE_START_BASE_DELAY', '0.2'))
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded'}
+
+# Branches processed by the trigger, comma separated fnmatch patterns (e.g. 'main,release/*')
+TRIGGER_BRANCH_PATTERNS = [pattern for pattern in os.environ.get('TRIGGER_BRANCH_PATTERNS', 'main').split(',')
+                           if pattern]
+BRANCH_WORKERS = int(os.environ.get('BRANCH_WORKERS', '4'))
+BRANCH_REF_PREFIX = 'refs/heads/'
+_NOT_LOADED = object()
+
+# Global budget of running pipeline executions (sum of their weights), 0 for no limit. The starts above the budget
+# are queued in SCHEDULER_QUEUE_URL and started by schedule_drainer.drain_schedule, by priority, as running
+# executions complete
+PIPELINE_START_BUDGET = int(os.environ.get('PIPELINE_START_BUDGET', '0'))
+SCHEDULER_QUEUE_URL = os.environ.get('SCHEDULER_QUEUE_URL')
+SCHEDULER_EXECUTION_TTL_SECONDS = int(os.environ.get('SCHEDULER_EXECUTION_TTL_SECONDS', '3600'))
+
+# Compiled pipeline maps kept across warm invocations: (repository, branch_name) -> (blob_id, PipelineRouter)
+_pipeline_router_cache = {}
+
+# Pipeline maps generated from service_map at synth time and bundled with the code, per branch.
+# The branches missing from it use the monorepo-{branch}.json file of the repository.
+ROUTING_ARTIFACT_PATH = os.environ.get('ROUTING_ARTIFACT_PATH',
+                                       os.path.join(os.path.dirname(os.path.abspath(__file__)), 'routing.json'))
+artifact_routers = load_routing_artifact(ROUTING_ARTIFACT_PATH)
+
+# Directory dependencies compiled at synth time and bundled with the code, a missing artifact is an empty graph
+DEPENDENCY_GRAPH_PATH = os.environ.get(
+    'DEPENDENCY_GRAPH_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dependency-graph.json'))
+dependency_graph = DependencyGraph.load(DEPENDENCY_GRAPH_PATH)
+
+# Priority and weight of the pipelines compiled at synth time, a missing artifact gives every pipeline the defaults
+PIPELINE_SCHEDULE_PATH = os.environ.get(
+    'PIPELINE_SCHEDULE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline-schedule.json'))
+pipeline_schedule = PipelineSchedule.load(PIPELINE_SCHEDULE_PATH)
+
+# With SnapStart, create the clients during init so they are part of the snapshot
+if os.environ.get('PRELOAD_CLIENTS'):
+    for service_name in ('codecommit', 'codepipeline', 'sqs'):
+        get_client(service_name)
+    get_last_commit_store()
+
+_INIT_DURATION_MS = (time.perf_counter() - _INIT_STARTED_AT) * 1000
+
+
+class PipelineStartError(Exception):
+    """
+    Some pipelines could not be started, the LastCommit record is not advanced so the range is retried
+    """
 
 
 def main(event, context):
     """
     This AWS Lambda is triggered by AWS CodeCommit event.
-    It starts AWS CodePipelines according to modifications in toplevel folders of the monorepo.
-    Each toplevel folder can be associate with a different AWS CodePipeline.
-    Must be run without concurrency - once at time for each monorepo (to avoid race condition while updating last commit parameter in SSM ParameterStore)
+    It starts AWS CodePipelines according to modifications in the folders of the monorepo.
+    Each folder (toplevel, nested or glob rule) can be associate with one or more AWS CodePipelines.
+    Every branch updated by the event and matching TRIGGER_BRANCH_PATTERNS is processed concurrently,
+    each against its own LastCommit parameter and monorepo-{branch}.json.
+    When deployed behind the FIFO queue (enqueue and consume), branches are serialised by the queue instead;
+    this entry point processes the event directly.
+    """
+    record_cold_start('main')
+    references = get_references(event)
+    logger.info('references: %s', references)
+    process_references(references)
+
+
+def enqueue(event, context):
+    """
+    This AWS Lambda is triggered by AWS CodeCommit event when the trigger runs behind the FIFO queue.
+    It sends one message per updated branch to TRIGGER_QUEUE_URL, in the message group of its (repository, branch):
+    pushes to the same branch are processed in order, other branches and repositories in parallel.
+    """
+    record_cold_start('enqueue')
+    references = get_references(event)
+    logger.info('references: %s', references)
+    entries = [build_queue_entry(index, repository, branch_name, commit_id)
+               for index, (repository, branch_name, commit_id) in enumerate(references)]
+    for start in range(0, len(entries), 10):
+        response = get_client('sqs').send_message_batch(QueueUrl=TRIGGER_QUEUE_URL, Entries=entries[start:start + 10])
+        if response.get('Failed'):
+            raise RuntimeError(f"could not enqueue references: {response['Failed']}")
+    return len(entries)
+
+
+def consume(event, context):
+    """
+    This AWS Lambda is triggered by the FIFO queue filled by enqueue.
+    Message groups are processed concurrently, the messages of a group in order. Returns a partial batch response:
+    when a message fails, it and every later message of its group are reported, so the group order is kept on retry.
+    """
+    record_cold_start('consume')
+    groups = {}
+    for record in event['Records']:
+        groups.setdefault(record['attributes']['MessageGroupId'], []).append(record)
+    if not groups:
+        return {'batchItemFailures': []}
+
+    messages = {group_id: [json.loads(record['body']) for record in records] for group_id, records in groups.items()}
+    stored_commits = get_stored_last_commits(
+        (group[0]['repository'], group[0]['branch']) for group in messages.values())
+
+    def process_group(group_id):
+        first = messages[group_id][0]
+        return process_message_group(groups[group_id], stored_commits[(first['repository'], first['branch'])])
+
+    workers = max(1, min(BRANCH_WORKERS, len(groups)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        failed_message_ids = [message_id for message_ids in executor.map(process_group, groups)
+                              for message_id in message_ids]
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]}
+
+
+def build_queue_entry(index, repository, branch_name, commit_id, pipelines=None, not_before=None):
+    """
+    SQS send_message_batch entry for one updated branch.
+    With pipelines, the entry is a deferred start of these pipelines, not to be processed before not_before.
+    """
+    group_id = f'{repository}/{branch_name}'
+    if len(group_id) > 128:
+        group_id = hashlib.sha256(group_id.encode()).hexdigest()
+    message = {'repository': repository, 'branch': branch_name, 'commit': commit_id}
+    deduplication_key = f'{repository}/{branch_name}/{commit_id}'
+    if pipelines is not None:
+        message.update(pipelines=list(pipelines), not_before=not_before)
+        deduplication_key = f"{deduplication_key}/{','.join(sorted(pipelines))}/{not_before}"
+    return {'Id': str(index),
+            'MessageBody': json.dumps(message),
+            'MessageGroupId': group_id,
+            'MessageDeduplicationId': hashlib.sha256(deduplication_key.encode()).hexdigest()}
+
+
+def process_message_group(records, stored_commit=_NOT_LOADED):
+    """
+    Process the messages of one (repository, branch) group together: the pushes are coalesced into a single run
+    up to the newest commit, which also starts the pipelines deferred by earlier runs.
+    On its first delivery, a group is delayed until COALESCE_WINDOW_SECONDS after its newest message
+    (and after the not_before of its deferred starts), so that the following pushes are coalesced with it.
+    stored_commit is the last commit of the branch, if already loaded.
+    Returns the ids of the messages that were not processed.
+    """
+    message_ids = [record['messageId'] for record in records]
+    messages = [json.loads(record['body']) for record in records]
+    delay = get_group_delay(records, messages)
+    if delay:
+        logger.info('delaying %d messages by %ds', len(records), delay)
+        delay_messages(records, delay)
+        return message_ids
+
+    pushes = [message for message in messages if 'pipelines' not in message]
+    deferred = list(dict.fromkeys(name for message in messages for name in message.get('pipelines', ())))
+    latest = (pushes or messages)[-1]
+    if len(pushes) > 1:
+        logger.info('coalescing %d pushes to %s/%s', len(pushes), latest['repository'], latest['branch'])
+    try:
+        if pushes:
+            process_reference(latest['repository'], latest['branch'], latest['commit'], stored_commit, deferred)
+        else:
+            start_deferred_pipelines(latest['repository'], latest['branch'], latest['commit'], deferred)
+    except Exception:
+        logger.exception('failed to process messages %s', message_ids)
+        return message_ids
+    return []
+
+
+def get_group_delay(records, messages):
     """
+    Seconds to wait before processing a message group, 0 if it is ready or was already received before
+    """
+    if any(int(record['attributes'].get('ApproximateReceiveCount', '1')) > 1 for record in records):
+        return 0
+    sent_at = max(int(record['attributes'].get('SentTimestamp', '0')) for record in records) / 1000
+    ready_at = max([sent_at + COALESCE_WINDOW_SECONDS] + [message.get('not_before') or 0 for message in messages])
+    return min(MAX_VISIBILITY_TIMEOUT, max(0, math.ceil(ready_at - time.time())))
+
+
+def delay_messages(records, delay):
+    """
+    Hide the messages of a group for delay seconds, they are delivered again with the messages queued meanwhile
+    """
+    entries = [{'Id': str(index), 'ReceiptHandle': record['receiptHandle'], 'VisibilityTimeout': delay}
+               for index, record in enumerate(records)]
+    for start in range(0, len(entries), 10):
+        response = get_client('sqs').change_message_visibility_batch(QueueUrl=TRIGGER_QUEUE_URL,
+                                                                     Entries=entries[start:start + 10])
+        if response.get('Failed'):
+            logger.warning('could not delay messages: %s', response['Failed'])
+
+
+def get_references(event):
+    """
+    Returns the (repository, branch_name, commit_id) updated by the event, for the branches matching
+    TRIGGER_BRANCH_PATTERNS. Deleted branches and tags are ignored, only the latest commit of a branch is kept.
+    """
+    references = {}
+    for record in event['Records']:
+        repository = record['eventSourceARN'].split(':')[5]
+        for reference in record['codecommit']['references']:
+            if reference.get('deleted') or not reference['ref'].startswith(BRANCH_REF_PREFIX):
+                continue
+            branch_name = get_branch_name(reference)
+            if any(fnmatchcase(branch_name, pattern) for pattern in TRIGGER_BRANCH_PATTERNS):
+                references[(repository, branch_name)] = get_commit_id(reference)
+    return [(repository, branch_name, commit_id) for (repository, branch_name), commit_id in references.items()]
 
-    logger.info('event: %s', event)
-    commit_id = get_commit_id(event)
-    branch_name = get_branch_name(event)
 
-    # logger.info('references: %s', references)
+def get_commit_id(reference):
+    return reference['commit']
 
-    repository = event['Records'][0]['eventSourceARN'].split(':')[5]
 
+def get_branch_name(reference):
+    return reference['ref'][len(BRANCH_REF_PREFIX):]
+
+
+def process_references(references):
+    """
+    Process each (repository, branch_name, commit_id) concurrently.
+    Returns {'repository/branch_name': start_codepipelines result}. If any branch failed,
+    the first error is raised once all branches are done, so the event is retried.
+    """
+    if not references:
+        return {}
+    stored_commits = get_stored_last_commits(references)
+    workers = max(1, min(BRANCH_WORKERS, len(references)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {f'{repository}/{branch_name}': executor.submit(process_reference, repository, branch_name, commit_id,
+                                                                  stored_commits[(repository, branch_name)])
+                   for repository, branch_name, commit_id in references}
+
+    errors = {key: future.exception() for key, future in futures.items() if future.exception()}
+    for key, error in errors.items():
+        logger.error('failed to process %s: %s', key, error)
+    if errors:
+        raise next(iter(errors.values()))
+    return {key: future.result() for key, future in futures.items()}
+
+
+def process_reference(repository, branch_name, commit_id, expected_commit=_NOT_LOADED, deferred_pipelines=()):
+    """
+    Start the pipelines affected by the commits pushed to one branch since its last run,
+    and the deferred_pipelines held back by earlier runs.
+    expected_commit is the stored last commit when it was already loaded (batched) by the caller.
+    The last commit is only advanced when no pipeline failed to start.
+    Timings and counts of each phase are emitted as embedded metric format, details are only logged when sampled.
+    """
+    metrics = InvocationMetrics(Repository=repository)
+    metrics.set_property('Branch', branch_name)
+    metrics.set_property('Commit', commit_id)
+    debug = is_sampled()
+    try:
+        with metrics.phase('Total'):
+            with metrics.phase('LastCommit'):
+                if expected_commit is _NOT_LOADED:
+                    expected_commit = get_stored_last_commit(repository, branch_name)
+                if expected_commit == commit_id:
+                    logger.info('%s/%s already triggered for commit %s', repository, branch_name, commit_id)
+                    return trigger_pipelines(repository, branch_name, commit_id, deferred_pipelines, metrics, debug)
+                last_commit = expected_commit or get_parent_commit(repository, commit_id)
+
+            with metrics.phase('Diff'):
+                matched_rules, router = collect_matched_rules(repository, commit_id, branch_name, last_commit,
+                                                              metrics=metrics, debug=debug)
+            with metrics.phase('Resolve'):
+                pipeline_names = resolve_pipeline_names(matched_rules, router)
+            logger.info('pipeline names (%s): %s', branch_name, pipeline_names)
+            results = trigger_pipelines(repository, branch_name, commit_id, [*pipeline_names, *deferred_pipelines],
+                                        metrics, debug)
+            with metrics.phase('UpdateLastCommit'):
+                update_last_commit(repository, commit_id, branch_name, expected_commit)
+            return results
+    except Exception:
+        metrics.put('Errors', 1)
+        raise
+    finally:
+        metrics.flush()
+
+
+def start_deferred_pipelines(repository, branch_name, commit_id, pipeline_names):
+    """
+    Start pipelines deferred by an earlier run, without diff nor last commit update
+    """
+    metrics = InvocationMetrics(Repository=repository)
+    metrics.set_property('Branch', branch_name)
+    metrics.set_property('Commit', commit_id)
+    try:
+        with metrics.phase('Total'):
+            return trigger_pipelines(repository, branch_name, commit_id, pipeline_names, metrics, is_sampled())
+    except Exception:
+        metrics.put('Errors', 1)
+        raise
+    finally:
+        metrics.flush()
+
+
+def trigger_pipelines(repository, branch_name, commit_id, pipeline_names, metrics, debug=False):
+    """
+    Start the pipelines for commit_id, applying IN_PROGRESS_POLICY to the ones already running and
+    PIPELINE_START_BUDGET to the others. Raises PipelineStartError when some could not be started,
+    the deferred ones are only queued otherwise.
+    """
+    pipeline_names = list(dict.fromkeys(pipeline_names))
+    with metrics.phase('State'):
+        pipeline_names, held = check_in_progress(pipeline_names, commit_id)
+    with metrics.phase('Schedule'):
+        pipeline_names, queued = schedule_pipelines(repository, branch_name, commit_id, pipeline_names)
+    with metrics.phase('Start'):
+        results = start_codepipelines(pipeline_names)
+        if PIPELINE_START_BUDGET and results:
+            record_executions(results)
+    results.update(held)
+    results.update(queued)
+    record_start_results(metrics, results)
+    if debug:
+        logger.info('start results (%s): %s', branch_name, results)
+
+    failed = [name for name, result in results.items() if result['status'] == 'failed']
+    if failed:
+        raise PipelineStartError(f'{repository}/{branch_name}@{commit_id}: could not start {failed}')
+    deferred = [name for name, result in results.items() if result['status'] == 'deferred']
+    if deferred:
+        defer_pipelines(repository, branch_name, commit_id, deferred)
+    return results
+
+
+def record_start_results(metrics, results):
+    """
+    Pipelines started, not found, failed, skipped, deferred and queued, and throttling retries,
+    from trigger_pipelines results
+    """
+    for status in ('started', 'not_found', 'failed', 'skipped', 'deferred', 'queued'):
+        metrics.put(f"Pipelines{status.title().replace('_', '')}",
+                    sum(1 for result in results.values() if result['status'] == status))
+    metrics.put('ApiRetries', sum(max(result['attempts'] - 1, 0) for result in results.values()))
+
+
+def check_in_progress(pipeline_names, commit_id):
+    """
+    Split the pipelines according to IN_PROGRESS_POLICY and their GetPipelineState (one call per pipeline,
+    none with the 'start' policy). Returns (names to start, {held name: result}), held pipelines are
+    'skipped' when already running commit_id and 'deferred' when running another commit.
+    """
+    if IN_PROGRESS_POLICY == 'start' or not pipeline_names:
+        return pipeline_names, {}
+
+    workers = max(1, min(PIPELINE_START_WORKERS, len(pipeline_names)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        states = dict(zip(pipeline_names, executor.map(get_pipeline_progress, pipeline_names)))
+
+    names, held = [], {}
+    for name, (execution_id, revision) in states.items():
+        if execution_id is not None and revision == commit_id:
+            held[name] = {'status': 'skipped', 'attempts': 0, 'execution_id': execution_id}
+        elif execution_id is not None and IN_PROGRESS_POLICY == 'defer' and TRIGGER_QUEUE_URL:
+            held[name] = {'status': 'deferred', 'attempts': 0, 'execution_id': execution_id}
+        else:
+            names.append(name)
+    if held:
+        logger.info('pipelines in progress: %s', held)
+    return names, held
+
+
+def get_pipeline_progress(codepipeline_name: str):
+    """
+    Returns (id of the running execution, source revision) from GetPipelineState, (None, None) when idle.
+    Errors are logged and the pipeline reported idle, so that it is started as without the check.
+    """
+    codepipeline = get_client('codepipeline')
+    try:
+        state = codepipeline.get_pipeline_state(name=codepipeline_name)
+    except codepipeline.exceptions.PipelineNotFoundException:
+        return None, None
+    except codepipeline.exceptions.ClientError as e:
+        logger.warning(f'Could not get the state of CodePipeline {codepipeline_name}: '
+                       f"{e.response.get('Error', {}).get('Code')}")
+        return None, None
+
+    stages = state.get('stageStates') or []
+    execution_id = next((stage['latestExecution'].get('pipelineExecutionId') for stage in stages
+                         if stage.get('latestExecution', {}).get('status') == 'InProgress'), None)
+    if execution_id is None:
+        return None, None
+    revisions = [action['currentRevision'].get('revisionId')
+                 for action in stages[0].get('actionStates', ()) if action.get('currentRevision')]
+    return execution_id, revisions[0] if revisions else None
+
+
+def defer_pipelines(repository, branch_name, commit_id, pipeline_names):
+    """
+    Queue the start of pipelines still running a previous commit in the message group of the branch,
+    to be processed IN_PROGRESS_RETRY_SECONDS later (or with the next push)
+    """
+    entry = build_queue_entry(0, repository, branch_name, commit_id, pipelines=pipeline_names,
+                              not_before=int(time.time()) + IN_PROGRESS_RETRY_SECONDS)
+    response = get_client('sqs').send_message_batch(QueueUrl=TRIGGER_QUEUE_URL, Entries=[entry])
+    if response.get('Failed'):
+        raise RuntimeError(f"could not defer {pipeline_names}: {response['Failed']}")
+
+
+def get_ledger() -> InFlightLedger:
+    """
+    The ledger is updated concurrently by every branch, catch-up and drain_schedule: it requires a last commit store
+    with atomic compare-and-swap (DynamoDB)
+    """
+    if isinstance(get_last_commit_store(), SsmLastCommitStore):
+        raise ValueError('the pipeline start budget requires the dynamodb last commit store '
+                         '(-c lastCommitStore=dynamodb)')
+    return InFlightLedger(get_last_commit_store(), pipeline_schedule, PIPELINE_START_BUDGET,
+                          SCHEDULER_EXECUTION_TTL_SECONDS)
+
+
+def schedule_pipelines(repository, branch_name, commit_id, pipeline_names):
+    """
+    Admit the pipelines within PIPELINE_START_BUDGET by priority, the others are queued for drain_schedule.
+    Returns (names to start, {queued name: result})
+    """
+    if not PIPELINE_START_BUDGET or not pipeline_names:
+        return pipeline_names, {}
+    admitted, held = get_ledger().admit(pipeline_names)
+    if not held:
+        return admitted, {}
+    logger.info('start budget exhausted, queuing %s', held)
+    queue_pipelines(repository, branch_name, commit_id, held)
+    return admitted, {name: {'status': 'queued', 'attempts': 0, 'execution_id': None} for name in held}
+
+
+def record_executions(results):
+    """
+    Record the execution ids of the started pipelines in the in-flight ledger, release the others.
+    The pipelines are already started: an error is only logged, so that the run is not retried and the pipelines
+    restarted. Their reservations then expire after SCHEDULER_EXECUTION_TTL_SECONDS.
+    """
+    try:
+        get_ledger().record({name: result['execution_id'] if result['status'] == 'started' else None
+                             for name, result in results.items()})
+    except Exception:
+        logger.exception('could not record the executions of %s in the in-flight ledger', sorted(results))
+
+
+def queue_pipelines(repository, branch_name, commit_id, pipeline_names, queued_at=None):
+    message = {'repository': repository, 'branch': branch_name, 'commit': commit_id,
+               'pipelines': list(pipeline_names), 'queued_at': queued_at or time.time()}
+    get_client('sqs').send_message(QueueUrl=SCHEDULER_QUEUE_URL, MessageBody=json.dumps(message))
+
+
+def collect_matched_rules(repository, commit_id, branch_name, last_commit=None, metrics=None, debug=False):
+    """
+    Walk the diff since the last run and return (matched pipeline map rules, pipeline router).
+    The rules of the directories depending on the modified ones (dependency graph) are matched as well.
+    The router comes from the routing artifact when it has the branch. Otherwise it comes from the map file
+    of the repository, cached across warm invocations unless the diff shows the map file changed.
+    In CONTENT_HASH_MODE the whole diff is walked and only the rules whose content digest changed are matched.
+    With metrics, the diff size and routing counts are recorded, with debug a sample of the directories is logged.
+    """
+    router = artifact_routers.get(branch_name)
+    from_artifact = router is not None
+    from_cache = (repository, branch_name) in _pipeline_router_cache
+    if not from_artifact:
+        router = get_pipeline_router(repository, branch_name)
+
+    map_path = build_pipeline_map_path(branch_name)
+    tracked_files = None if from_artifact else {map_path: None}
     paths = get_modified_files_since_last_run(
-        repositoryName=repository, afterCommitSpecifier=commit_id, branch_name=branch_name)
+        repositoryName=repository, afterCommitSpecifier=commit_id, branch_name=branch_name, tracked_files=tracked_files,
+        last_commit=last_commit, metrics=metrics, content_hash=CONTENT_HASH_MODE)
+    if metrics is not None:
+        paths = count_items(paths, metrics, 'PathsDiffed')
+    seen_dirs = set()
+    if CONTENT_HASH_MODE:
+        dir_digests = sum_dir_digests(paths)
+        matched_rules = set()
+    else:
+        matched_rules = router.match_paths(paths, watched_rules=router.pipeline_map.keys(), seen_dirs=seen_dirs)
+
+    # The map file was touched, or the walk stopped early and may not have reached it yet
+    map_blob_id = None if from_artifact else tracked_files[map_path]
+    if not from_artifact and (map_blob_id is not None or (from_cache and not CONTENT_HASH_MODE
+                                                          and matched_rules.issuperset(router.pipeline_map))):
+        current_router = get_pipeline_router(repository, branch_name, blob_id=map_blob_id or None, revalidate=True)
+        if current_router is not router:
+            router = current_router
+            if not CONTENT_HASH_MODE:
+                matched_rules = {rule for dirname in seen_dirs for rule in router.match_dir(dirname)}
+                unseen_rules = router.pipeline_map.keys() - matched_rules
+                if unseen_rules:
+                    matched_rules |= router.match_paths(paths, watched_rules=unseen_rules, seen_dirs=seen_dirs)
+    if CONTENT_HASH_MODE:
+        matched_rules, unchanged_rules = match_content_changes(router, dir_digests)
+        seen_dirs = {dirname for dirname, digest in dir_digests.items() if digest}
+        logger.info('rules with unchanged content: %s', unchanged_rules)
+        if metrics is not None:
+            metrics.put('RulesUnchanged', len(unchanged_rules))
+    impacted_rules = {rule for dirname in dependency_graph.impacted(seen_dirs)
+                      for rule in router.match_dir(dirname)} - matched_rules
+    logger.info('matched rules: %s, impacted by dependencies: %s', matched_rules, impacted_rules)
+    if metrics is not None:
+        metrics.put('DirsSeen', len(seen_dirs))
+        metrics.put('DirsMatched', sum(1 for dirname in seen_dirs if router.match_dir(dirname)))
+        metrics.put('RulesMatched', len(matched_rules))
+        metrics.put('RulesImpacted', len(impacted_rules))
+    matched_rules |= impacted_rules
+    if debug:
+        logger.info('modified dirs (sample): %s', sorted(itertools.islice(seen_dirs, 50)))
+    return matched_rules, router
+
+
+def sum_dir_digests(changes):
+    """
+    Add up the (path, digest delta) changes per directory, modulo DIGEST_MODULUS
+    """
+    dir_digests = {}
+    for path, digest in changes:
+        dirname, separator, _ = path.rpartition('/')
+        if separator:
+            dir_digests[dirname] = (dir_digests.get(dirname, 0) + digest) % DIGEST_MODULUS
+    return dir_digests
 
-    logger.info('paths: %s', paths)
-    print(paths)
-    toplevel_dirs = get_unique_toplevel_dirs(paths)
-    print("unique toplevl dirs:", toplevel_dirs)
-    pipeline_names = resolve_pipeline_names(toplevel_dirs, repository, branch_name)
-    print("pipeline_names:", pipeline_names)
-    print(start_codepipelines(pipeline_names))
 
-    update_last_commit(repository, commit_id, branch_name)
+def match_content_changes(router: PipelineRouter, dir_digests):
+    """
+    Returns (rules whose content changed, rules only touched by content-neutral differences).
+    The digest of each directory routed to a rule is weighted by the hash of its path, then added up: the digests
+    only cancel out when the files of the rule are byte-identical, at the same paths.
+    """
+    rule_digests = {}
+    for dirname, digest in dir_digests.items():
+        weighted = digest * path_digest(dirname)
+        for rule in router.match_dir(dirname):
+            rule_digests[rule] = (rule_digests.get(rule, 0) + weighted) % DIGEST_MODULUS
+    changed_rules = {rule for rule, digest in rule_digests.items() if digest}
+    return changed_rules, rule_digests.keys() - changed_rules
 
 
-def get_commit_id(event):
-    return event['Records'][0]['codecommit']['references'][0]['commit']
+def path_digest(*parts) -> int:
+    """
+    Non-zero hash of path components, modulo DIGEST_MODULUS
+    """
+    digest = int.from_bytes(hashlib.sha256('\0'.join(parts).encode()).digest()[:16], 'big') % DIGEST_MODULUS
+    return digest or 1
 
 
-def get_branch_name(event):
-    branch_ref = event['Records'][0]['codecommit']['references'][0]['ref']
-    return branch_ref.split('/')[-1]
+def count_items(items, metrics, name):
+    """
+    Pass-through iterator adding the number of items consumed to a metric
+    """
+    metrics.add(name, 0)
+    for item in items:
+        metrics.values[name] += 1
+        yield item
 
 
-def resolve_pipeline_names(toplevel_dirs, repository, branch_name):
+def build_pipeline_map_path(branch_name):
     """
-    Look up for pipeline names according to the toplevel dir names. 
-    File name with the mapping (folder -> codepipeline-name) must be in the root level of the repo.
-    Returns CodePipeline names that need to be triggered.
+    Path of the mapping file (folder -> codepipeline-name) in the root level of the repo.
+    Slashes in the branch name are replaced ('release/1.0' -> 'monorepo-release-1.0.json').
     """
-    pipeline_map = codecommit.get_file(repositoryName=repository,
-                                       commitSpecifier=f'refs/heads/{branch_name}', filePath=f'monorepo-{branch_name}.json')['fileContent']
-    pipeline_map = json.loads(pipeline_map)
-    pipeline_names = []
-    for dir in toplevel_dirs:
-        if dir in pipeline_map:
-            pipeline_names.append(pipeline_map[dir])
-    return pipeline_names
+    return f"monorepo-{branch_name.replace('/', '-')}.json"
 
 
-def get_unique_toplevel_dirs(modified_files):
+def get_pipeline_router(repository, branch_name, blob_id=None, revalidate=False):
     """
-    Returns toplevel folders that were modified by the last commit(s)
+    Return the router compiled from the mapping file (folder -> codepipeline-name),
+    cached per repository and branch by blob id.
+    With a known blob_id the map is only downloaded (get_blob) if the cached copy is of a different blob.
+    With revalidate the branch head is read again (get_file), but the router is not recompiled if unchanged.
     """
-    toplevel_dirs = set(
-        [splitted[0] for splitted in (file.split('/') for file in modified_files)
-         if len(splitted) > 1]
-    )
+    cached = _pipeline_router_cache.get((repository, branch_name))
+    if cached and (cached[0] == blob_id or (blob_id is None and not revalidate)):
+        return cached[1]
+
+    if blob_id:
+        content = get_client('codecommit').get_blob(repositoryName=repository, blobId=blob_id)['content']
+    else:
+        response = get_client('codecommit').get_file(repositoryName=repository,
+                                                     commitSpecifier=f'{BRANCH_REF_PREFIX}{branch_name}',
+                                                     filePath=build_pipeline_map_path(branch_name))
+        blob_id, content = response['blobId'], response['fileContent']
+        if cached and cached[0] == blob_id:
+            return cached[1]
 
-    logger.info('toplevel dirs: %s', toplevel_dirs)
-    return toplevel_dirs
+    router = PipelineRouter(json.loads(content))
+    _pipeline_router_cache[(repository, branch_name)] = (blob_id, router)
+    return router
+
+
+def resolve_pipeline_names(matched_rules, router: PipelineRouter):
+    """
+    Look up for pipeline names according to the matched pipeline map rules.
+    File name with the mapping (folder -> codepipeline-name) must be in the root level of the repo.
+    Returns CodePipeline names that need to be triggered.
+    """
+    return router.pipeline_names(matched_rules)
 
 
 def start_codepipelines(codepipeline_names: list) -> dict:
     """
-    start CodePipeline (s)
-    Returns a tupple with 2 list: (success_started_pipelines, failed_to_start_pipelines)
+    start CodePipeline (s) concurrently, using a bounded thread pool over the module-level client.
+    Returns a dict keyed by pipeline name with the outcome of each start:
+    {'status': 'started' | 'not_found' | 'failed', 'latency_ms': float, 'attempts': int, 'execution_id': str}
     """
-    codepipeline_client = boto3.Session().client('codepipeline')
+    unique_names = list(dict.fromkeys(codepipeline_names))
+    if not unique_names:
+        return {}
+
+    workers = max(1, min(PIPELINE_START_WORKERS, len(unique_names)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(unique_names, executor.map(start_codepipeline, unique_names)))
 
-    failed_codepipelines = []
-    started_codepipelines = []
-    for codepipeline_name in codepipeline_names:
+
+def start_codepipeline(codepipeline_name: str) -> dict:
+    """
+    Start a single CodePipeline, retrying throttling errors with full-jitter exponential backoff.
+    """
+    codepipeline = get_client('codepipeline')
+    started_at = time.perf_counter()
+    result = {'status': 'failed', 'attempts': 0, 'execution_id': None}
+    for attempt in range(1, PIPELINE_START_MAX_ATTEMPTS + 1):
+        result['attempts'] = attempt
         try:
-            codepipeline_client.start_pipeline_execution(
-                name=codepipeline_name
-            )
+            response = codepipeline.start_pipeline_execution(name=codepipeline_name)
+            result.update(status='started', execution_id=response.get('pipelineExecutionId'))
             logger.info(f'Started CodePipeline {codepipeline_name}.')
-            started_codepipelines.append(codepipeline_name)
-        except codepipeline_client.exceptions.PipelineNotFoundException:
+            break
+        except codepipeline.exceptions.PipelineNotFoundException:
             logger.info(f'Could not find CodePipeline {codepipeline_name}.')
-            failed_codepipelines.append(codepipeline_name)
-
-    return (started_codepipelines, failed_codepipelines)
+            result['status'] = 'not_found'
+            break
+        except codepipeline.exceptions.ClientError as e:
+            error_code = e.response.get('Error', {}).get('Code')
+            if error_code not in THROTTLING_ERROR_CODES or attempt == PIPELINE_START_MAX_ATTEMPTS:
+                logger.error(f'Could not start CodePipeline {codepipeline_name}: {error_code}')
+                result['error'] = error_code
+                break
+            time.sleep(random.uniform(0, PIPELINE_START_BASE_DELAY * 2 ** (attempt - 1)))
+    result['latency_ms'] = round((time.perf_counter() - started_at) * 1000, 2)
+    return result
 
 
 def build_parameter_name(repository, branch_name):
@@ -111,6 +745,37 @@ def build_parameter_name(repository, branch_name):
     return f'/MonoRepoTrigger/{repository}/{branch_name}/LastCommit'
 
 
+def get_stored_last_commit(repository, branch_name):
+    """
+    Returns the commit id stored in the last commit store for '/MonoRepoTrigger/{repository}/{branch_name}/LastCommit',
+    None if it does not exist yet
+    """
+    return get_last_commit_store().get(build_parameter_name(repository, branch_name))
+
+
+def get_stored_last_commits(references):
+    """
+    Batched get_stored_last_commit for several (repository, branch_name, ...) references, in a single
+    round trip for up to 10 (SSM) or 100 (DynamoDB) branches
+    """
+    names = {build_parameter_name(repository, branch_name): (repository, branch_name)
+             for repository, branch_name, *_ in references}
+    stored = get_last_commit_store().get_many(names)
+    return {key: stored.get(name) for name, key in names.items()}
+
+
+def get_parent_commit(repository, commit_id):
+    """
+    Returns the first parent of a commit, None for the initial commit
+    """
+    commit = get_client('codecommit').get_commit(
+        repositoryName=repository, commitId=commit_id)['commit']
+    parent = None
+    if commit['parents']:
+        parent = commit['parents'][0]
+    return parent
+
+
 def get_last_commit(repository, commit_id, branch_name):
     """
     Get last triggered commit id. 
@@ -118,57 +783,104 @@ def get_last_commit(repository, commit_id, branch_name):
               if does not exist, get the parent commit from the commit that triggers this lambda
     Return last triggered commit hash
     """
-    param_name = build_parameter_name(repository, branch_name)
-    try:
-        return ssm.get_parameter(Name=param_name)['Parameter']['Value']
-    except botocore.exceptions.ClientError:
-        logger.info('not found ssm parameter %s', param_name)
-        commit = codecommit.get_commit(
-            repositoryName=repository, commitId=commit_id)['commit']
-        parent = None
-        if commit['parents']:
-            parent = commit['parents'][0]
-        return parent
+    return get_stored_last_commit(repository, branch_name) or get_parent_commit(repository, commit_id)
 
 
-def update_last_commit(repository, commit_id, branch_name):
+def update_last_commit(repository, commit_id, branch_name, expected_commit=None):
     """
-    Update '/MonoRepoTrigger/{repository}/LastCommit' SSM Parameter Store with the current commit that triggered the lambda
+    Update '/MonoRepoTrigger/{repository}/LastCommit' in the last commit store with the current commit
+    that triggered the lambda.
+    Compare-and-swap: the record must still hold expected_commit (or not exist when expected_commit is None),
+    otherwise LastCommitConflict is raised.
     """
-    ssm.put_parameter(Name=build_parameter_name(repository, branch_name),
-                      Description='Keep track of the last commit already triggered',
-                      Value=commit_id,
-                      Type='String',
-                      Overwrite=True)
+    get_last_commit_store().compare_and_swap(build_parameter_name(repository, branch_name), expected_commit, commit_id)
 
 
-def get_modified_files_since_last_run(repositoryName, afterCommitSpecifier, branch_name):
+def iter_differences(repositoryName, afterCommitSpecifier, beforeCommitSpecifier=None, metrics=None):
     """
-    Get all modified files since last time the lambda was triggered. Developer can push several commit at once, 
-    so the number of commits between beforeCommit and afterCommit can be greater than one.
+    Generator over all differences between two commits, following NextToken.
+    Only one page of differences is held in memory at a time.
+    """
+    kwargs = dict(repositoryName=repositoryName, afterCommitSpecifier=afterCommitSpecifier)
+    if beforeCommitSpecifier:
+        kwargs['beforeCommitSpecifier'] = beforeCommitSpecifier
+    while True:
+        page = get_client('codecommit').get_differences(**kwargs)
+        if metrics is not None:
+            metrics.add('DiffPages')
+            metrics.add('DiffSize', len(page['differences']))
+        yield from page['differences']
+        next_token = page.get('NextToken')
+        if not next_token:
+            return
+        kwargs['NextToken'] = next_token
+
+
+def iter_modified_paths(differences, tracked_files=None):
+    """
+    Yield the before and after paths of each difference (renames and moves produce both).
+    For each path present in tracked_files, its new blob id is recorded there as it goes by ('' when deleted).
+    """
+    for d in differences:
+        before_path = d.get('beforeBlob', {}).get('path')
+        after_path = d.get('afterBlob', {}).get('path')
+        if tracked_files is not None:
+            track_file(tracked_files, before_path, after_path, d)
+        if before_path is not None:
+            yield before_path
+        if after_path is not None and after_path != before_path:
+            yield after_path
+
+
+def iter_blob_digests(differences, tracked_files=None):
+    """
+    Yield (path, digest delta) for the before and after blobs of each difference. The content digest of a
+    directory is the sum of the hashes of its (file name, blob id) pairs: the after blob is added and the before
+    blob subtracted, so the deltas of a directory only cancel out when its files are byte-identical (mode-only
+    changes). tracked_files is filled as in iter_modified_paths.
     """
+    for d in differences:
+        before_blob = d.get('beforeBlob') or {}
+        after_blob = d.get('afterBlob') or {}
+        before_path, after_path = before_blob.get('path'), after_blob.get('path')
+        if tracked_files is not None:
+            track_file(tracked_files, before_path, after_path, d)
+        if before_path is not None:
+            yield before_path, -blob_digest(before_path, before_blob)
+        if after_path is not None:
+            yield after_path, blob_digest(after_path, after_blob)
 
-    last_commit = get_last_commit(repositoryName, afterCommitSpecifier, branch_name)
-    print("last_commit: ", last_commit)
-    print("commit_id: ", afterCommitSpecifier)
-    # TODO working with next_token to paginate
-    diff = None
-    if last_commit:
-        diff = codecommit.get_differences(repositoryName=repositoryName, beforeCommitSpecifier=last_commit,
-                                          afterCommitSpecifier=afterCommitSpecifier)['differences']
-    else:
-        diff = codecommit.get_differences(repositoryName=repositoryName,
-                                          afterCommitSpecifier=afterCommitSpecifier)['differences']
 
-    logger.info('diff: %s', diff)
+def blob_digest(path: str, blob: dict) -> int:
+    return path_digest(path.rpartition('/')[2], blob.get('blobId') or '')
+
+
+def track_file(tracked_files, before_path, after_path, difference):
+    if after_path in tracked_files:
+        tracked_files[after_path] = difference['afterBlob'].get('blobId', '')
+    elif before_path in tracked_files:
+        tracked_files[before_path] = ''
+
 
-    before_blob_paths = {d.get('beforeBlob', {}).get('path') for d in diff}
-    after_blob_paths = {d.get('afterBlob', {}).get('path') for d in diff}
+def get_modified_files_since_last_run(repositoryName, afterCommitSpecifier, branch_name, tracked_files=None,
+                                      last_commit=None, metrics=None, content_hash=False):
+    """
+    Get all modified files since last time the lambda was triggered. Developer can push several commit at once, 
+    so the number of commits between beforeCommit and afterCommit can be greater than one.
+    Returns a lazy iterator: differences are paged from CodeCommit only as the paths are consumed.
+    With content_hash, it yields (path, digest delta) pairs instead of paths (see iter_blob_digests).
+    """
 
-    all_modifications = before_blob_paths.union(after_blob_paths)
-    return filter(lambda f: f is not None, all_modifications)
+    if last_commit is None:
+        last_commit = get_last_commit(repositoryName, afterCommitSpecifier, branch_name)
+    logger.info('diff %s..%s', last_commit, afterCommitSpecifier)
+    differences = iter_differences(repositoryName, afterCommitSpecifier, last_commit, metrics)
+    if content_hash:
+        return iter_blob_digests(differences, tracked_files)
+    return iter_modified_paths(differences, tracked_files)
 
 
 if __name__ == '__main__':
     main({'Records': [{'codecommit': {'references': [{'commit': 'a6528d2dd877288e7c0ebdf9860d356e6d4bd073',
-                                                      }]}, 'eventSourceARN': ':::::repo-test-trigger-lambda'}]}, {})
+                                                      'ref': 'refs/heads/main'}]},
+                       'eventSourceARN': ':::::repo-test-trigger-lambda'}]}, {})
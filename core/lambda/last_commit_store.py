@@ -0,0 +1,130 @@
+"""
+Stores for the last commit triggered on each (repository, branch).
+
+Records are addressed by name ('/MonoRepoTrigger/{repository}/{branch}/LastCommit') and only ever updated with
+compare-and-swap, so a commit range is never skipped or processed twice by two concurrent invocations.
+"""
+from abc import ABC, abstractmethod
+import threading
+
+
+class LastCommitConflict(Exception):
+    """
+    The record was advanced by another invocation since it was read
+    """
+
+
+class LastCommitStore(ABC):
+
+    @abstractmethod
+    def get_many(self, names) -> dict:
+        """
+        Returns {name: value} for the records that exist, in as few calls as the backend allows
+        """
+        pass
+
+    @abstractmethod
+    def compare_and_swap(self, name: str, expected, value: str):
+        """
+        Sets the record to value if it still holds expected (None: the record must not exist),
+        raises LastCommitConflict otherwise
+        """
+        pass
+
+    def get(self, name: str):
+        return self.get_many([name]).get(name)
+
+
+class SsmLastCommitStore(LastCommitStore):
+    """
+    SSM Parameter Store backend. Creation is atomic (Overwrite=False), but SSM has no conditional update:
+    the value is read before being overwritten, which is safe as long as the updates of a record are serialised
+    (the trigger FIFO queue has one message group per repository and branch).
+    """
+
+    def __init__(self, ssm_client):
+        self.ssm = ssm_client
+
+    def get_many(self, names) -> dict:
+        names = list(dict.fromkeys(names))
+        values = {}
+        for start in range(0, len(names), 10):
+            response = self.ssm.get_parameters(Names=names[start:start + 10])
+            values.update((parameter['Name'], parameter['Value']) for parameter in response['Parameters'])
+        return values
+
+    def compare_and_swap(self, name: str, expected, value: str):
+        if expected is not None:
+            current = self.get(name)
+            if current != expected:
+                raise LastCommitConflict(f'{name} is {current}, expected {expected}')
+        try:
+            self.ssm.put_parameter(Name=name,
+                                   Description='Keep track of the last commit already triggered',
+                                   Value=value,
+                                   Type='String',
+                                   Overwrite=expected is not None)
+        except self.ssm.exceptions.ParameterAlreadyExists:
+            raise LastCommitConflict(f'{name} was created by another invocation')
+
+
+class DynamoDbLastCommitStore(LastCommitStore):
+    """
+    DynamoDB backend: one item per record (partition key 'id', attribute 'value'), updated with conditional writes.
+    Reads of several branches are batched with BatchGetItem. Each branch is written on its own, once its pipelines
+    are started, so that a failure on one branch never holds back or rolls back the others.
+    """
+
+    def __init__(self, dynamodb_client, table_name: str):
+        self.dynamodb = dynamodb_client
+        self.table_name = table_name
+
+    def get_many(self, names) -> dict:
+        names = list(dict.fromkeys(names))
+        values = {}
+        for start in range(0, len(names), 100):
+            request = {self.table_name: {'Keys': [{'id': {'S': name}} for name in names[start:start + 100]],
+                                         'ConsistentRead': True}}
+            while request:
+                response = self.dynamodb.batch_get_item(RequestItems=request)
+                values.update((item['id']['S'], item['value']['S'])
+                              for item in response['Responses'].get(self.table_name, ()))
+                request = response.get('UnprocessedKeys')
+        return values
+
+    def compare_and_swap(self, name: str, expected, value: str):
+        try:
+            self.dynamodb.put_item(TableName=self.table_name, **self._conditional_put(name, expected, value))
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            raise LastCommitConflict(f'{name} is not {expected}')
+
+    @staticmethod
+    def _conditional_put(name, expected, value):
+        put = {'Item': {'id': {'S': name}, 'value': {'S': value}}}
+        if expected is None:
+            put['ConditionExpression'] = 'attribute_not_exists(id)'
+        else:
+            put['ConditionExpression'] = '#value = :expected'
+            put['ExpressionAttributeNames'] = {'#value': 'value'}
+            put['ExpressionAttributeValues'] = {':expected': {'S': expected}}
+        return put
+
+
+class InMemoryLastCommitStore(LastCommitStore):
+    """
+    Process local backend, for tests and offline runs
+    """
+
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+        self._lock = threading.Lock()
+
+    def get_many(self, names) -> dict:
+        with self._lock:
+            return {name: self.values[name] for name in names if name in self.values}
+
+    def compare_and_swap(self, name: str, expected, value: str):
+        with self._lock:
+            if self.values.get(name) != expected:
+                raise LastCommitConflict(f'{name} is {self.values.get(name)}, expected {expected}')
+            self.values[name] = value
@@ -0,0 +1,75 @@
+"""
+Per-invocation metrics of the trigger, emitted as CloudWatch embedded metric format (EMF) log lines:
+CloudWatch Logs extracts the metrics from the JSON, no PutMetricData call is made.
+"""
+from contextlib import contextmanager
+import json
+import os
+import random
+import time
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'MonorepoTrigger')
+# Share of the invocations logging debug details (sample of the modified directories, start results)
+DEBUG_SAMPLE_RATE = float(os.environ.get('DEBUG_SAMPLE_RATE', '0.01'))
+
+
+class InvocationMetrics:
+
+    def __init__(self, **dimensions):
+        self.dimensions = dimensions
+        self.properties = {}
+        self.values = {}
+        self.units = {}
+
+    def add(self, name: str, value=1, unit: str = 'Count'):
+        """
+        Adds value to a metric (created at 0)
+        """
+        self.values[name] = self.values.get(name, 0) + value
+        self.units[name] = unit
+
+    def put(self, name: str, value, unit: str = 'Count'):
+        self.values[name] = value
+        self.units[name] = unit
+
+    def set_property(self, name: str, value):
+        """
+        Context logged with the metrics, without being a metric or a dimension
+        """
+        self.properties[name] = value
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Records the duration of the block as the metric '{name}Ms'
+        """
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(f'{name}Ms', round((time.perf_counter() - started_at) * 1000, 3), 'Milliseconds')
+
+    def to_emf(self) -> dict:
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [list(self.dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': self.units[name]} for name in self.values],
+                }],
+            },
+            **self.properties,
+            **self.dimensions,
+            **self.values,
+        }
+
+    def flush(self):
+        print(json.dumps(self.to_emf(), default=str))
+
+
+def is_sampled() -> bool:
+    """
+    Whether this invocation logs debug details, decided once per call with DEBUG_SAMPLE_RATE
+    """
+    return DEBUG_SAMPLE_RATE > 0 and random.random() < DEBUG_SAMPLE_RATE
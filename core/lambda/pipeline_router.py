@@ -0,0 +1,182 @@
+"""
+Path router compiled from the pipeline map (monorepo-{branch}.json).
+
+Each key of the map is a directory rule and each value a pipeline name, or a list of pipeline names:
+    "demo":                 "codepipeline-demo-main"        every file under demo/
+    "services/payments/api": "codepipeline-payments-api"    nested service directories
+    "services/*/worker":    "codepipeline-workers"          '*' (or any fnmatch pattern) matches one directory
+    "libs/common/**":       ["codepipeline-a", "codepipeline-b"]
+                                                             '**' matches any number of directories
+A changed path is routed to the most specific matching rule (longest prefix, literal segments win over
+wildcards at the same depth). Files at the root level of the repository never match.
+
+The maps can also come from the routing artifact generated at synth time (core/routing_artifact.py):
+    {"version": 1, "branches": {"main": {"demo": ["codepipeline-demo-main"], ...}}}
+
+Only the directory prefix of a routed path is kept (directory cache, seen directories), never the path itself,
+and one copy of each directory. Rules and pipeline names are interned, so that the trie, the map and the
+resolved names share a single copy of each.
+"""
+from fnmatch import fnmatchcase
+import sys
+
+from artifacts import read_artifact
+from bounded_cache import BoundedCache
+
+GLOBSTAR = '**'
+GLOB_CHARS = frozenset('*?[')
+ROUTING_ARTIFACT_VERSION = 1
+
+
+class _Node:
+    __slots__ = ('literals', 'patterns', 'globstar', 'is_globstar', 'rules')
+
+    def __init__(self, is_globstar=False):
+        self.literals = {}
+        self.patterns = []
+        self.globstar = None
+        self.is_globstar = is_globstar
+        self.rules = ()
+
+
+class PipelineRouter:
+
+    def __init__(self, pipeline_map: dict):
+        self.pipeline_map = {}
+        self._root = _Node()
+        self._specificity = {}
+        self._dir_cache = BoundedCache()
+        self._winners = {}
+        for rule, pipeline_names in pipeline_map.items():
+            self.add_rule(rule, pipeline_names)
+
+    def add_rule(self, rule: str, pipeline_names):
+        """
+        Compile a directory rule into the trie
+        """
+        rule = sys.intern(rule)
+        segments = [segment for segment in rule.split('/') if segment]
+        while segments and segments[-1] == GLOBSTAR:
+            segments.pop()
+
+        node = self._root
+        literal_count = 0
+        for segment in segments:
+            if segment == GLOBSTAR:
+                if node.globstar is None:
+                    node.globstar = _Node(is_globstar=True)
+                node = node.globstar
+            elif GLOB_CHARS.intersection(segment):
+                child = next((child for pattern, child in node.patterns if pattern == segment), None)
+                if child is None:
+                    child = _Node()
+                    node.patterns.append((segment, child))
+                node = child
+            else:
+                literal_count += 1
+                node = node.literals.setdefault(segment, _Node())
+
+        if rule not in node.rules:
+            node.rules += (rule,)
+        if isinstance(pipeline_names, str):
+            pipeline_names = [pipeline_names]
+        self.pipeline_map[rule] = [sys.intern(name) for name in pipeline_names]
+        self._specificity[rule] = (len(segments) - segments.count(GLOBSTAR), literal_count)
+        self._dir_cache.clear()
+        self._winners.clear()
+
+    def match(self, path: str) -> tuple:
+        """
+        Returns the rules that own a file path (empty when no rule matches)
+        """
+        dirname, separator, _ = path.rpartition('/')
+        if not separator:
+            return ()
+        return self.match_dir(dirname)
+
+    def match_dir(self, dirname: str) -> tuple:
+        """
+        Returns the most specific rules matching a directory. Walks the trie once per path segment,
+        results are memoized per directory since large diffs touch many files in the same directories.
+        """
+        winners = self._dir_cache.get(dirname)
+        if winners is not None:
+            return winners
+
+        active = _with_globstars((self._root,))
+        candidates = [rule for node in active for rule in node.rules]
+        for segment in dirname.split('/'):
+            reached = []
+            for node in active:
+                child = node.literals.get(segment)
+                if child is not None:
+                    reached.append(child)
+                for pattern, child in node.patterns:
+                    if fnmatchcase(segment, pattern):
+                        reached.append(child)
+                if node.is_globstar:
+                    reached.append(node)
+            if not reached:
+                break
+            active = _with_globstars(reached)
+            candidates.extend(rule for node in active for rule in node.rules)
+
+        if candidates:
+            best = max(self._specificity[rule] for rule in candidates)
+            winners = tuple(dict.fromkeys(rule for rule in candidates if self._specificity[rule] == best))
+            # Directories of a service share one tuple of winners
+            winners = self._winners.setdefault(winners, winners)
+        else:
+            winners = ()
+        self._dir_cache[dirname] = winners
+        return winners
+
+    def match_paths(self, paths, watched_rules=None, seen_dirs=None) -> set:
+        """
+        Returns the rules matched by the modified paths.
+        When watched_rules is given, stops consuming paths as soon as every watched rule has been matched,
+        so a lazy diff is not paged any further than needed.
+        When seen_dirs is given, the directories of the consumed paths are added to it.
+        """
+        pending = set(watched_rules) if watched_rules is not None else None
+        matched_rules = set()
+        for path in paths:
+            dirname, separator, _ = path.rpartition('/')
+            if not separator:
+                continue
+            if seen_dirs is not None:
+                seen_dirs.add(dirname)
+            rules = self.match_dir(dirname)
+            if not rules:
+                continue
+            matched_rules.update(rules)
+            if pending is not None:
+                pending.difference_update(rules)
+                if not pending:
+                    break
+        return matched_rules
+
+    def pipeline_names(self, rules) -> list:
+        """
+        Returns the unique pipeline names associated with the rules
+        """
+        return list(dict.fromkeys(name for rule in sorted(rules) for name in self.pipeline_map.get(rule, ())))
+
+
+def load_routing_artifact(path: str) -> dict:
+    """
+    Returns {branch: PipelineRouter} compiled from a routing artifact, empty when the file does not exist
+    """
+    pipeline_maps = read_artifact(path, ROUTING_ARTIFACT_VERSION, 'branches', 'routing artifact') or {}
+    return {branch: PipelineRouter(pipeline_map) for branch, pipeline_map in pipeline_maps.items()}
+
+
+def _with_globstars(nodes):
+    """
+    Adds the '**' nodes reachable without consuming a segment ('**' also matches zero directories)
+    """
+    expanded = list(dict.fromkeys(nodes))
+    for node in expanded:
+        if node.globstar is not None and node.globstar not in expanded:
+            expanded.append(node.globstar)
+    return expanded
@@ -0,0 +1,152 @@
+"""
+Start scheduling of the trigger: a global budget of running pipeline executions, shared by every branch.
+
+Each pipeline has a priority and a weight, compiled at synth time from ServicePipeline.priority() and weight()
+(see core/pipeline_schedule.py) and bundled with the lambda code; the pipelines missing from the artifact have
+priority 0 and weight 1:
+    {"version": 1, "pipelines": {"codepipeline-hotfix-main": {"priority": 100, "weight": 1}}}
+The executions started by the trigger are kept in an in-flight ledger, a single record of the last commit store
+updated with compare-and-swap by every branch, catch-up and drain_schedule, so only with the DynamoDB store (atomic
+compare-and-swap, 400 KB items):
+    {"codepipeline-demo-main": [weight, started at (epoch seconds), execution id], ...}
+An entry is released when its execution completes (CodePipeline state change event), or expires after ttl seconds
+when the event was missed.
+"""
+import json
+import random
+import time
+
+from artifacts import read_artifact
+from last_commit_store import LastCommitConflict, LastCommitStore
+
+ARTIFACT_VERSION = 1
+LEDGER_NAME = '/MonoRepoTrigger/Scheduler/InFlight'
+
+
+class PipelineSchedule:
+
+    def __init__(self, pipelines: dict = None):
+        self.pipelines = pipelines or {}
+
+    @classmethod
+    def load(cls, path: str) -> 'PipelineSchedule':
+        """
+        Reads an artifact, a missing file is a schedule with the default priority and weight only
+        """
+        return cls(read_artifact(path, ARTIFACT_VERSION, 'pipelines', 'pipeline schedule'))
+
+    def priority(self, name: str) -> int:
+        return self.pipelines.get(name, {}).get('priority', 0)
+
+    def weight(self, name: str) -> int:
+        return self.pipelines.get(name, {}).get('weight', 1)
+
+    def order(self, names) -> list:
+        """
+        Unique names by decreasing priority, in their original order within a priority
+        """
+        return sorted(dict.fromkeys(names), key=lambda name: -self.priority(name))
+
+
+class InFlightLedger:
+
+    def __init__(self, store: LastCommitStore, schedule: PipelineSchedule, budget: int, ttl: int = 3600,
+                 name: str = LEDGER_NAME, max_attempts: int = 8):
+        self.store = store
+        self.schedule = schedule
+        self.budget = budget
+        self.ttl = ttl
+        self.name = name
+        self.max_attempts = max_attempts
+
+    def entries(self) -> dict:
+        return self._read()[1]
+
+    def used(self) -> int:
+        return sum(weight for weight, _, _ in self.entries().values())
+
+    def admit(self, names) -> tuple:
+        """
+        Reserves the budget for the pipelines to start, by priority. Returns (admitted, held) names.
+        A pipeline already running is admitted without taking more budget (its new execution supersedes or waits
+        for the running one). A pipeline heavier than the whole budget is admitted when nothing else runs.
+        Once a pipeline is held, the pipelines of lower priority are held too, so that smaller pipelines do not
+        keep taking the budget a heavier, more urgent one is waiting for.
+        """
+        def change(entries):
+            used = sum(weight for weight, _, _ in entries.values())
+            admitted, held = [], []
+            held_priority = None
+            for name in self.schedule.order(names):
+                weight, priority = self.schedule.weight(name), self.schedule.priority(name)
+                if name in entries:
+                    entries[name] = [entries[name][0], int(time.time()), None]
+                    admitted.append(name)
+                elif (used + weight <= self.budget or used == 0) and (held_priority is None
+                                                                       or priority >= held_priority):
+                    entries[name] = [weight, int(time.time()), None]
+                    used += weight
+                    admitted.append(name)
+                else:
+                    held.append(name)
+                    if held_priority is None:
+                        held_priority = priority
+            return admitted, held
+
+        return self._update(change)
+
+    def record(self, executions: dict):
+        """
+        Records the execution ids of the admitted pipelines, {name: execution id}. The reservation of the pipelines
+        whose start failed (execution id None) is released.
+        """
+        def change(entries):
+            for name, execution_id in executions.items():
+                entry = entries.get(name)
+                if entry is None or entry[2] is not None:
+                    continue
+                if execution_id:
+                    entry[2] = execution_id
+                else:
+                    del entries[name]
+
+        self._update(change)
+
+    def release(self, name: str, execution_id: str) -> bool:
+        """
+        Releases the budget of a completed execution. Returns False when the ledger does not hold this execution
+        (started outside the trigger, already superseded by a newer start, or expired).
+        """
+        def change(entries):
+            entry = entries.get(name)
+            if entry is None or entry[2] != execution_id:
+                return False
+            del entries[name]
+            return True
+
+        return self._update(change)
+
+    def _read(self):
+        raw = self.store.get(self.name)
+        now = time.time()
+        entries = {name: entry for name, entry in (json.loads(raw) if raw else {}).items()
+                   if now - entry[1] < self.ttl}
+        return raw, entries
+
+    def _update(self, change):
+        """
+        Applies change(entries) to the ledger with compare-and-swap, retried with jitter on conflict.
+        Returns the result of change.
+        """
+        for attempt in range(self.max_attempts):
+            raw, entries = self._read()
+            result = change(entries)
+            value = json.dumps(entries, separators=(',', ':'), sort_keys=True)
+            if value == raw or (raw is None and not entries):
+                return result
+            try:
+                self.store.compare_and_swap(self.name, raw, value)
+                return result
+            except LastCommitConflict:
+                time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+        raise LastCommitConflict(f'{self.name}: too many concurrent updates')
@@ -0,0 +1,88 @@
+"""
+Drainer of the pipeline starts queued above PIPELINE_START_BUDGET by the trigger (handler.py): the completed
+executions release their share of the budget in the in-flight ledger (pipeline_scheduler.py), then the queued
+pipelines are started by priority as long as the budget allows.
+"""
+import json
+import logging
+import os
+
+from handler import (SCHEDULER_QUEUE_URL, get_client, get_ledger, queue_pipelines, record_cold_start,
+                     record_executions, record_start_results, start_codepipelines)
+from metrics import InvocationMetrics
+from pipeline_scheduler import InFlightLedger
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Queued messages considered per invocation, and the execution states releasing the budget
+SCHEDULER_DRAIN_MESSAGES = int(os.environ.get('SCHEDULER_DRAIN_MESSAGES', '100'))
+COMPLETED_EXECUTION_STATES = {'SUCCEEDED', 'FAILED', 'STOPPED', 'SUPERSEDED'}
+
+
+def drain_schedule(event, context):
+    """
+    This AWS Lambda is triggered by the CodePipeline execution state changes, and on schedule, when
+    PIPELINE_START_BUDGET is set. A completed execution releases its share of the budget, then the queued starts
+    are started by priority (oldest first within a priority) as long as the budget allows.
+    Up to SCHEDULER_DRAIN_MESSAGES queued messages are considered per invocation.
+    """
+    record_cold_start('drain_schedule')
+    ledger = get_ledger()
+    detail = event.get('detail') or {}
+    if detail.get('state') in COMPLETED_EXECUTION_STATES and detail.get('execution-id'):
+        released = ledger.release(detail['pipeline'], detail['execution-id'])
+        logger.info('%s %s %s, released: %s', detail['pipeline'], detail['execution-id'], detail['state'], released)
+
+    sqs = get_client('sqs')
+    messages = []
+    while len(messages) < SCHEDULER_DRAIN_MESSAGES:
+        received = sqs.receive_message(QueueUrl=SCHEDULER_QUEUE_URL, MaxNumberOfMessages=10, WaitTimeSeconds=0,
+                                       VisibilityTimeout=60).get('Messages', [])
+        if not received:
+            break
+        messages.extend(received)
+    metrics = InvocationMetrics(EntryPoint='drain_schedule')
+    try:
+        with metrics.phase('Total'):
+            results = start_queued_pipelines(ledger, messages)
+        record_start_results(metrics, results)
+        metrics.put('BudgetUsed', ledger.used())
+    finally:
+        metrics.flush()
+    return {name: result['status'] for name, result in results.items()}
+
+
+def start_queued_pipelines(ledger: InFlightLedger, messages):
+    """
+    Admit and start the pipelines of the queued messages. The messages whose pipelines were all started
+    (or not found) are deleted, the others are made visible again with their remaining pipelines.
+    """
+    bodies = [json.loads(message['Body']) for message in messages]
+    order = sorted(range(len(messages)), key=lambda index: bodies[index].get('queued_at', 0))
+    queued = [name for index in order for name in bodies[index]['pipelines']]
+    if not queued:
+        return {}
+    admitted, held = ledger.admit(queued)
+    results = start_codepipelines(admitted)
+    if results:
+        record_executions(results)
+    done = {name for name, result in results.items() if result['status'] in ('started', 'not_found')}
+    results.update((name, {'status': 'queued', 'attempts': 0, 'execution_id': None}) for name in held)
+
+    sqs = get_client('sqs')
+    deleted, visible = [], []
+    for message, body in zip(messages, bodies):
+        remaining = [name for name in body['pipelines'] if name not in done]
+        if len(remaining) == len(body['pipelines']):
+            visible.append({'Id': str(len(visible)), 'ReceiptHandle': message['ReceiptHandle'], 'VisibilityTimeout': 0})
+            continue
+        if remaining:
+            queue_pipelines(body['repository'], body['branch'], body['commit'], remaining, body.get('queued_at'))
+        deleted.append({'Id': str(len(deleted)), 'ReceiptHandle': message['ReceiptHandle']})
+    for start in range(0, len(deleted), 10):
+        sqs.delete_message_batch(QueueUrl=SCHEDULER_QUEUE_URL, Entries=deleted[start:start + 10])
+    for start in range(0, len(visible), 10):
+        sqs.change_message_visibility_batch(QueueUrl=SCHEDULER_QUEUE_URL, Entries=visible[start:start + 10])
+    logger.info('queued pipelines started: %s, still queued: %s', sorted(done), held)
+    return results
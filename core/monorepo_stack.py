@@ -1,14 +1,24 @@
 from aws_cdk import (Stack, RemovalPolicy, Duration, CfnParameter,
                      aws_lambda as lambda_,
+                     aws_lambda_event_sources as lambda_event_sources,
+                     aws_sqs as sqs,
                      aws_codecommit as codecommit,
+                     aws_dynamodb as dynamodb,
+                     aws_events as events,
+                     aws_events_targets as events_targets,
                      aws_iam as iam,
                      aws_s3 as s3,
                      aws_s3_deployment as s3_deployment)
 from constructs import Construct
+import hashlib
 import os
+import shutil
 import zipfile
 import tempfile
 import json
+import monorepo_config
+from core import artifacts, dependency_graph, pipeline_schedule, routing_artifact
+from core.pipeline_registry import collect_service_map, load_service_pipeline
 
 
 class MonorepoStack(Stack):
@@ -23,7 +33,11 @@ class MonorepoStack(Stack):
                                          description='CodeCommit Monorepo name',
                                          default='monorepo-sample')
 
-        branch_for_trigger = 'main'
+        # Branch patterns handled by the trigger, e.g. cdk deploy -c triggerBranches=main,release/*
+        trigger_branches = self.node.try_get_context('triggerBranches') or ['main']
+        if isinstance(trigger_branches, str):
+            trigger_branches = [branch.strip() for branch in trigger_branches.split(',') if branch.strip()]
+        default_branch = next((branch for branch in trigger_branches if not is_branch_pattern(branch)), 'main')
 
         function_name = f'{monorepo_name.value_as_string}-codecommit-handler'
         repository_name = monorepo_name.value_as_string
@@ -31,43 +45,241 @@ class MonorepoStack(Stack):
         account = Stack.of(self).account
 
 
-        monorepo = self.create_codecommit_repo(repository_name, branch_for_trigger)
+        monorepo = self.create_codecommit_repo(repository_name, default_branch)
 
-        monorepo_lambda = self.create_lambda(region, account, repository_name, function_name)
+        # Last commit store backend: 'ssm' (default) or 'dynamodb' (conditional writes, batched reads)
+        last_commit_store = self.node.try_get_context('lastCommitStore') or 'ssm'
+        last_commit_table = self.create_last_commit_table() if last_commit_store == 'dynamodb' else None
+
+        # Init time optimisations of the trigger lambdas: Graviton (default) and SnapStart (opt-in)
+        arm64 = str(self.node.try_get_context('lambdaArm64') or 'true').lower() == 'true'
+        snap_start = str(self.node.try_get_context('lambdaSnapStart') or 'false').lower() == 'true'
+
+        # Burst pushes: coalescing window of the pushes to a branch, and policy for the pipelines already running
+        # ('start', 'skip' the ones running the same commit, 'defer' the ones running another commit)
+        coalesce_window = int(self.node.try_get_context('coalesceWindowSeconds') or 0)
+        in_progress_policy = self.node.try_get_context('inProgressPolicy') or 'start'
+        # Do not trigger the services whose files are byte-identical after a push (mode-only changes)
+        content_hash = str(self.node.try_get_context('contentHashMode') or 'false').lower() == 'true'
+        # Global budget of running pipeline executions (sum of the pipeline weights), 0 for no limit. Its in-flight
+        # ledger is updated concurrently by every branch: it needs the atomic compare-and-swap of the DynamoDB store
+        start_budget = int(self.node.try_get_context('pipelineStartBudget') or 0)
+        if start_budget and last_commit_table is None:
+            raise ValueError('pipelineStartBudget requires the dynamodb last commit store '
+                             '(-c lastCommitStore=dynamodb)')
+
+        trigger_queue = self.create_trigger_queue()
+        self.create_lambda(region, account, repository_name, function_name, trigger_branches, trigger_queue,
+                           last_commit_table, arm64=arm64, snap_start=snap_start, coalesce_window=coalesce_window,
+                           in_progress_policy=in_progress_policy, content_hash=content_hash, start_budget=start_budget)
         
-        monorepo.grant_read(monorepo_lambda)
-        monorepo.notify(f"arn:aws:lambda:{region}:{account}:function:{function_name}",
-                        name="lambda-codecommit-event", branches=[branch_for_trigger])
+        # CodeCommit triggers only accept exact branch names: with patterns, trigger on all branches and filter
+        # in the lambda
+        notify_branches = None if any(is_branch_pattern(branch) for branch in trigger_branches) else trigger_branches
+        notify_target = f"arn:aws:lambda:{region}:{account}:function:{function_name}"
+        if snap_start:
+            notify_target = f'{notify_target}:{SNAP_START_ALIAS}'
+        monorepo.notify(notify_target, name="lambda-codecommit-event", branches=notify_branches)
         self.exported_monorepo = monorepo
+        # Exports of the repository used by the pipeline stacks, kept when their stacks are left out of the
+        # synth (onlyChangedPipelines): a deployed consumer still imports them
+        self.export_value(monorepo.repository_arn)
+        self.export_value(monorepo.repository_name)
+
+
+    def create_trigger_queue(self):
+        # FIFO queue in front of the trigger: one message group per (repository, branch), so pushes to a branch are
+        # processed in order while unrelated branches and repositories are processed in parallel
+        dead_letter_queue = sqs.Queue(self, 'TriggerDeadLetterQueue',
+                                      fifo=True,
+                                      retention_period=Duration.days(14))
+        return sqs.Queue(self, 'TriggerQueue',
+                         fifo=True,
+                         visibility_timeout=Duration.seconds(360),
+                         dead_letter_queue=sqs.DeadLetterQueue(queue=dead_letter_queue, max_receive_count=5))
+
+    def create_last_commit_table(self):
+        return dynamodb.Table(self, 'LastCommitTable',
+                              partition_key=dynamodb.Attribute(name='id', type=dynamodb.AttributeType.STRING),
+                              billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                              removal_policy=RemovalPolicy.DESTROY)
 
+    def lambda_init_options(self, arm64, snap_start):
+        # SnapStart for Python needs the python3.12 runtime
+        return dict(runtime=lambda_.Runtime('python3.12', lambda_.RuntimeFamily.PYTHON) if snap_start
+                    else lambda_.Runtime.PYTHON_3_11,
+                    architecture=lambda_.Architecture.ARM_64 if arm64 else lambda_.Architecture.X86_64,
+                    code=self.lambda_code(),
+                    timeout=Duration.seconds(60))
 
-    def create_lambda(self, region, account, repository_name, function_name):
-        # Lambda function which triggers code pipeline according
-        # Function must run with concurrency = 1 -- to avoid race condition
+    def lambda_code(self):
+        # Lambda sources bundled with the artifacts compiled from monorepo_config, staged once per stack
+        if getattr(self, '_lambda_code', None) is None:
+            staging_dir = os.path.join(tempfile.mkdtemp('lambda-code'), 'lambda')
+            shutil.copytree('core/lambda/', staging_dir, ignore=shutil.ignore_patterns('__pycache__', '*.pyc'))
+            for artifact, payload in (
+                    (dependency_graph, dependency_graph.compile_dependents(monorepo_config.service_dependencies)),
+                    (routing_artifact, self.pipeline_maps()),
+                    (pipeline_schedule, pipeline_schedule.build_schedule(self.service_pipelines()))):
+                artifacts.write_artifact(staging_dir, artifact.ARTIFACT_NAME, artifact.ARTIFACT_VERSION,
+                                         artifact.ARTIFACT_KEY, payload)
+            self._lambda_code = lambda_.Code.from_asset(staging_dir)
+        return self._lambda_code
+
+    def pipeline_maps(self):
+        # Pipeline map of each branch generated from service_map, validated once per stack
+        if getattr(self, '_pipeline_maps', None) is None:
+            self._pipeline_maps = routing_artifact.build_pipeline_maps(self.service_pipelines(),
+                                                                       monorepo_config.service_dependencies)
+        return self._pipeline_maps
+
+    def service_pipelines(self):
+        # The routing and schedule artifacts need the name, branch, priority and weight of every pipeline: each
+        # pipeline class is imported and instantiated once per stack, none of their constructs is built
+        if getattr(self, '_service_pipelines', None) is None:
+            self._service_pipelines = {dir_name: load_service_pipeline(entry) for dir_name, entry
+                                       in collect_service_map(monorepo_config.service_map).items()}
+        return self._service_pipelines
+
+    def enable_snap_start(self, function: lambda_.Function):
+        # Snapshot the initialised function (AWS clients preloaded) on publish and invoke it through an alias
+        function.node.default_child.add_property_override('SnapStart', {'ApplyOn': 'PublishedVersions'})
+        function.add_environment('PRELOAD_CLIENTS', '1')
+        return lambda_.Alias(self, f'{function.node.id}Alias', alias_name=SNAP_START_ALIAS,
+                             version=function.current_version)
+
+    def create_lambda(self, region, account, repository_name, function_name, trigger_branches, trigger_queue,
+                      last_commit_table=None, arm64=True, snap_start=False, coalesce_window=0,
+                      in_progress_policy='start', content_hash=False, start_budget=0):
+        # Lambda function which receives the CodeCommit events and enqueues them, one message per updated branch
         monorepo_lambda = lambda_.Function(self, "CodeCommitEventHandler",
                                            function_name=function_name,
-                                           runtime=lambda_.Runtime.PYTHON_3_11,
-                                           code=lambda_.Code.from_asset("core/lambda/"),
-                                           handler="handler.main",
-                                           timeout=Duration.seconds(60),
+                                           handler="handler.enqueue",
                                            dead_letter_queue_enabled=True,
-                                           reserved_concurrent_executions=1)
+                                           environment={'TRIGGER_BRANCH_PATTERNS': ','.join(trigger_branches),
+                                                        'TRIGGER_QUEUE_URL': trigger_queue.queue_url},
+                                           **self.lambda_init_options(arm64, snap_start))
+        # Asynchronous invocations failing after their retries land in this queue, drained by the catch-up lambda
+        enqueue_dead_letter_queue = monorepo_lambda.dead_letter_queue
+        if snap_start:
+            monorepo_lambda = self.enable_snap_start(monorepo_lambda)
         monorepo_lambda.add_permission("codecommit-permission",
                                        principal=iam.ServicePrincipal("codecommit.amazonaws.com"),
                                        action="lambda:InvokeFunction",
                                        source_arn=f"arn:aws:codecommit:{region}:{account}:{repository_name}")
-        monorepo_lambda.add_to_role_policy(
+        trigger_queue.grant_send_messages(monorepo_lambda)
+
+        # Lambda function which triggers code pipeline according to the queued branch updates
+        # No reserved concurrency: the queue message groups avoid races on the LastCommit parameter of a branch
+        worker_lambda = lambda_.Function(self, "TriggerQueueHandler",
+                                         function_name=f'{function_name}-worker',
+                                         handler="handler.consume",
+                                         environment={'TRIGGER_QUEUE_URL': trigger_queue.queue_url,
+                                                      'COALESCE_WINDOW_SECONDS': str(coalesce_window),
+                                                      'IN_PROGRESS_POLICY': in_progress_policy,
+                                                      'CONTENT_HASH_MODE': str(content_hash).lower()},
+                                         **self.lambda_init_options(arm64, snap_start))
+        # Deferred pipeline starts are queued back by the worker
+        trigger_queue.grant_send_messages(worker_lambda)
+        if last_commit_table:
+            worker_lambda.add_environment('LAST_COMMIT_STORE', 'dynamodb')
+            worker_lambda.add_environment('LAST_COMMIT_TABLE', last_commit_table.table_name)
+            last_commit_table.grant_read_write_data(worker_lambda)
+        worker_function = worker_lambda
+        if snap_start:
+            worker_lambda = self.enable_snap_start(worker_lambda)
+        worker_lambda.add_event_source(lambda_event_sources.SqsEventSource(trigger_queue,
+                                                                           batch_size=10,
+                                                                           report_batch_item_failures=True))
+        self.grant_trigger_permissions(worker_lambda, region, account, repository_name)
+
+        # Lambda function catching the branches up after an outage, and draining both dead-letter queues. It advances
+        # LastCommit outside of the message groups of the trigger queue, so it is only created with the DynamoDB
+        # store, whose compare-and-swap is atomic
+        trigger_functions = [worker_function]
+        if last_commit_table:
+            dead_letter_queues = [trigger_queue.dead_letter_queue.queue, enqueue_dead_letter_queue]
+            catch_up_lambda = lambda_.Function(self, "TriggerCatchUpHandler",
+                                               function_name=f'{function_name}-catch-up',
+                                               handler="catch_up.catch_up",
+                                               environment={'TRIGGER_BRANCH_PATTERNS': ','.join(trigger_branches),
+                                                            'TRIGGER_QUEUE_URL': trigger_queue.queue_url,
+                                                            'DEAD_LETTER_QUEUE_URLS': ','.join(
+                                                                queue.queue_url for queue in dead_letter_queues),
+                                                            'IN_PROGRESS_POLICY': in_progress_policy,
+                                                            'CONTENT_HASH_MODE': str(content_hash).lower(),
+                                                            'LAST_COMMIT_STORE': 'dynamodb',
+                                                            'LAST_COMMIT_TABLE': last_commit_table.table_name},
+                                               **{**self.lambda_init_options(arm64, False),
+                                                  'timeout': Duration.minutes(15)})
+            trigger_queue.grant_send_messages(catch_up_lambda)
+            for queue in dead_letter_queues:
+                queue.grant_consume_messages(catch_up_lambda)
+            last_commit_table.grant_read_write_data(catch_up_lambda)
+            self.grant_trigger_permissions(catch_up_lambda, region, account, repository_name)
+            trigger_functions.append(catch_up_lambda)
+
+        if start_budget:
+            self.create_scheduler(region, account, repository_name, function_name, trigger_functions,
+                                  last_commit_table, start_budget, arm64)
+        return monorepo_lambda
+
+    def create_scheduler(self, region, account, repository_name, function_name, trigger_functions, last_commit_table,
+                         start_budget, arm64):
+        # Queue of the pipeline starts above the budget, drained by priority as executions complete
+        schedule_queue = sqs.Queue(self, 'PipelineScheduleQueue',
+                                   retention_period=Duration.days(14))
+        scheduler_environment = {'PIPELINE_START_BUDGET': str(start_budget),
+                                 'SCHEDULER_QUEUE_URL': schedule_queue.queue_url}
+        for function in trigger_functions:
+            for key, value in scheduler_environment.items():
+                function.add_environment(key, value)
+            schedule_queue.grant_send_messages(function)
+
+        # A single drainer at a time: the in-flight ledger is only contended by the trigger functions
+        scheduler_lambda = lambda_.Function(self, "PipelineSchedulerHandler",
+                                            function_name=f'{function_name}-scheduler',
+                                            handler="schedule_drainer.drain_schedule",
+                                            environment={**scheduler_environment,
+                                                         'LAST_COMMIT_STORE': 'dynamodb',
+                                                         'LAST_COMMIT_TABLE': last_commit_table.table_name},
+                                            reserved_concurrent_executions=1,
+                                            **self.lambda_init_options(arm64, False))
+        schedule_queue.grant_consume_messages(scheduler_lambda)
+        schedule_queue.grant_send_messages(scheduler_lambda)
+        last_commit_table.grant_read_write_data(scheduler_lambda)
+        self.grant_trigger_permissions(scheduler_lambda, region, account, repository_name)
+
+        # Completed executions free their share of the budget; the schedule catches up missed events and expiries
+        events.Rule(self, 'PipelineExecutionCompleted',
+                    event_pattern=events.EventPattern(
+                        source=['aws.codepipeline'],
+                        detail_type=['CodePipeline Pipeline Execution State Change'],
+                        detail={'state': ['SUCCEEDED', 'FAILED', 'STOPPED', 'SUPERSEDED']}),
+                    targets=[events_targets.LambdaFunction(scheduler_lambda)])
+        events.Rule(self, 'PipelineScheduleDrain',
+                    schedule=events.Schedule.rate(Duration.minutes(1)),
+                    targets=[events_targets.LambdaFunction(scheduler_lambda)])
+        return scheduler_lambda
+
+    def grant_trigger_permissions(self, function: lambda_.Function, region, account, repository_name):
+        # Last commit parameters, pipeline state and starts, and reads of the monorepo
+        function.add_to_role_policy(
             iam.PolicyStatement(resources=[f'arn:aws:ssm:{region}:{account}:parameter/MonoRepoTrigger/*'],
                                 actions=['ssm:GetParameter', 'ssm:GetParameters', 'ssm:PutParameter']))
-        monorepo_lambda.add_to_role_policy(
+        function.add_to_role_policy(
             iam.PolicyStatement(resources=[f'arn:aws:codepipeline:{region}:{account}:*'],
-                                actions=['codepipeline:GetPipeline', 'codepipeline:ListPipelines',
-                                'codepipeline:StartPipelineExecution', 'codepipeline:StopPipelineExecution']))
-        return monorepo_lambda
+                                actions=['codepipeline:GetPipeline', 'codepipeline:GetPipelineState',
+                                         'codepipeline:ListPipelines', 'codepipeline:StartPipelineExecution',
+                                         'codepipeline:StopPipelineExecution']))
+        function.add_to_role_policy(
+            iam.PolicyStatement(resources=[f'arn:aws:codecommit:{region}:{account}:{repository_name}'],
+                                actions=['codecommit:GetBlob', 'codecommit:GetBranch', 'codecommit:GetCommit',
+                                         'codecommit:GetDifferences', 'codecommit:GetFile']))
 
 
-    def create_codecommit_repo(self, repository_name, branch_for_trigger):
-        tmp_dir = zip_sample()
+    def create_codecommit_repo(self, repository_name, default_branch):
+        tmp_dir = zip_sample(self.pipeline_maps())
         sample_bucket = s3.Bucket(self, 'MonoRepoSample',
                                   removal_policy=RemovalPolicy.DESTROY,
                                   auto_delete_objects=True)
@@ -77,20 +289,53 @@ class MonorepoStack(Stack):
         monorepo = codecommit.Repository(self, "monorepo", repository_name=repository_name)
         cfn_repo = monorepo.node.find_child('Resource')
         cfn_repo.code = codecommit.CfnRepository.CodeProperty(s3={'bucket': sample_bucket.bucket_name, 'key': 'sample.zip'},
-                                                              branch_name=branch_for_trigger)
+                                                              branch_name=default_branch)
         monorepo.node.add_dependency(sample_deployment)
         return monorepo
 
 
-def zip_sample():
-    # codepipeline_map = {}
-    # for dir_name, service_pipeline in monorepo_config.service_map.items():
-    #     codepipeline_map[dir_name] = service_pipeline.pipeline_name()
-    tempdir = tempfile.mkdtemp('bucket-sample')
-    with zipfile.ZipFile(os.path.join(tempdir, 'sample.zip'), 'w') as zf:
-        # zf.writestr(f'monorepo-{branch_name}.json', json.dumps(codepipeline_map))
-        for dirname, subdirs, files in os.walk("./monorepo-sample/"):
-            for filename in files:
-                relativepath = os.path.join(dirname.replace("./monorepo-sample/", ""), filename)
-                zf.write(os.path.join(dirname, filename), arcname=relativepath)
-    return tempdir
+SNAP_START_ALIAS = 'live'
+SAMPLE_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'monorepo-sample-cache')
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def is_branch_pattern(branch):
+    return any(char in branch for char in '*?[')
+
+
+def zip_sample(pipeline_maps, cache_dir=SAMPLE_CACHE_DIR):
+    # The mapping files of the sample are generated from service_map (monorepo-{branch}.json)
+    entries = {f"monorepo-{branch.replace('/', '-')}.json":
+               json.dumps({rule: names[0] if len(names) == 1 else names for rule, names in pipeline_map.items()},
+                          indent=4).encode()
+               for branch, pipeline_map in pipeline_maps.items()}
+    for dirname, subdirs, files in os.walk("./monorepo-sample/"):
+        for filename in files:
+            relativepath = os.path.join(dirname.replace("./monorepo-sample/", ""), filename).replace(os.sep, '/')
+            if relativepath not in entries:
+                with open(os.path.join(dirname, filename), 'rb') as sample_file:
+                    entries[relativepath] = sample_file.read()
+
+    # Same content, same archive: one directory per content hash, only written when missing, so the asset hash
+    # of the BucketDeployment source does not change between synths
+    digest = hashlib.sha256()
+    for arcname in sorted(entries):
+        digest.update(f'{arcname}\0{len(entries[arcname])}\0'.encode())
+        digest.update(entries[arcname])
+    sample_dir = os.path.join(cache_dir, f'sample-{digest.hexdigest()[:32]}')
+    zip_path = os.path.join(sample_dir, 'sample.zip')
+    if not os.path.exists(zip_path):
+        os.makedirs(sample_dir, exist_ok=True)
+        # Written next to sample_dir, not in it: sample_dir is the asset directory, a partial archive in it would
+        # be picked up by a concurrent synth
+        partial_path = f'{sample_dir}.{os.getpid()}.zip.tmp'
+        with zipfile.ZipFile(partial_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            # Sorted entries with fixed timestamps and permissions make the archive reproducible
+            for arcname in sorted(entries):
+                info = zipfile.ZipInfo(arcname, date_time=ZIP_DATE_TIME)
+                info.create_system = 3
+                info.external_attr = 0o644 << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                zf.writestr(info, entries[arcname])
+        os.replace(partial_path, zip_path)
+    return sample_dir
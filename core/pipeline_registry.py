@@ -0,0 +1,191 @@
+"""
+Lazy registry of the service pipelines built by PipelineStack.
+
+A service_map entry is a ServicePipeline instance, or a 'module.path:ClassName' string imported on demand: when
+MonoRepoStack compiles the trigger artifacts (name, branch, priority and weight of every pipeline), when a
+pipeline is built or fingerprinted. Pipelines can also be registered by installed packages, as entry points of the
+'monorepo.pipelines' group (name: folder-name, value: 'module.path:ClassName').
+
+Pipelines can be split across several stacks by shard (stable crc32 of the folder name), and each shard has a
+fingerprint of its pipeline definition files, so that synth can skip the shards that have not changed. The
+fingerprints are recorded once the stacks are deployed, and the changed stacks listed before deploying:
+    python -m core.pipeline_registry --shards 8
+    python -m core.pipeline_registry --shards 8 --list-changed
+"""
+from importlib import import_module, metadata
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import zlib
+from typing import Dict, List, Union
+
+from core.abstract_service_pipeline import ServicePipeline
+
+ENTRY_POINT_GROUP = 'monorepo.pipelines'
+DEFAULT_FINGERPRINT_CACHE = '.pipelines-fingerprints.json'
+# Files every pipeline definition depends on, the CDK version and app settings included: a change to one of them
+# changes every shard
+SHARED_DEFINITION_FILES = ['core/abstract_service_pipeline.py', 'core/pipelines_stack.py', 'requirements.txt',
+                           'setup.py', 'cdk.json']
+
+ServiceMapEntry = Union[ServicePipeline, str]
+
+
+def entry_point_service_map(group: str = ENTRY_POINT_GROUP) -> Dict[str, str]:
+    """
+    Returns {folder-name: 'module.path:ClassName'} registered as entry points, without importing them
+    """
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        entry_points = entry_points.select(group=group)
+    else:
+        entry_points = entry_points.get(group, [])
+    return {entry_point.name: entry_point.value for entry_point in entry_points}
+
+
+def collect_service_map(service_map: Dict[str, ServiceMapEntry]) -> Dict[str, ServiceMapEntry]:
+    """
+    The entry points merged with service_map, service_map wins for a folder registered in both
+    """
+    return {**entry_point_service_map(), **service_map}
+
+
+def resolve_entry(entry: ServiceMapEntry):
+    """
+    Imports the class (or object) of a 'module.path:ClassName' entry, instances are returned as is
+    """
+    if not isinstance(entry, str):
+        return entry
+    module_name, _, attribute = entry.partition(':')
+    if not attribute:
+        raise ValueError(f"invalid pipeline entry '{entry}', expected 'module.path:ClassName'")
+    return getattr(import_module(module_name), attribute)
+
+
+def load_service_pipeline(entry: ServiceMapEntry) -> ServicePipeline:
+    """
+    Imports a 'module.path:ClassName' entry and instantiates the class, instances are returned as is
+    """
+    service_pipeline = resolve_entry(entry)
+    if inspect.isclass(service_pipeline):
+        service_pipeline = service_pipeline()
+    if not isinstance(service_pipeline, ServicePipeline):
+        raise TypeError(f"{entry} is not a ServicePipeline")
+    return service_pipeline
+
+
+def definition_files(entry: ServiceMapEntry) -> List[str]:
+    """
+    Source files of a pipeline class and of the classes it derives from, relative to the project directory.
+    The modules are imported, but no construct is built.
+    """
+    service_pipeline = resolve_entry(entry)
+    pipeline_class = service_pipeline if inspect.isclass(service_pipeline) else type(service_pipeline)
+    files = []
+    for base in inspect.getmro(pipeline_class):
+        try:
+            path = os.path.relpath(inspect.getsourcefile(base))
+        except (TypeError, ValueError):
+            continue
+        if not path.startswith('..'):
+            files.append(path)
+    return files
+
+
+def shard_of(dir_name: str, shards: int) -> int:
+    """
+    Stable shard of a service: adding or removing a service does not move the others
+    """
+    return zlib.crc32(dir_name.encode()) % shards
+
+
+def shard_service_map(service_map: Dict[str, ServiceMapEntry], shards: int) -> List[Dict[str, ServiceMapEntry]]:
+    shard_maps = [{} for _ in range(shards)]
+    for dir_name, entry in service_map.items():
+        shard_maps[shard_of(dir_name, shards)][dir_name] = entry
+    return shard_maps
+
+
+def pipeline_stack_name(shard: int, shards: int) -> str:
+    return "PipelinesStack" if shards == 1 else f"PipelinesStack-{shard}"
+
+
+def fingerprint(service_map: Dict[str, ServiceMapEntry]) -> str:
+    """
+    Hash of a shard: its folders and entries, the content of their definition files (base classes included)
+    and of the shared files
+    """
+    digest = hashlib.sha256()
+    files = set(SHARED_DEFINITION_FILES)
+    for dir_name in sorted(service_map):
+        entry = service_map[dir_name]
+        digest.update(f'{dir_name}={entry if isinstance(entry, str) else type(entry).__qualname__}\n'.encode())
+        files.update(definition_files(entry))
+    for path in sorted(files):
+        digest.update(path.encode())
+        with open(path, 'rb') as definition:
+            digest.update(hashlib.sha256(definition.read()).digest())
+    return digest.hexdigest()
+
+
+class FingerprintCache:
+    """
+    Fingerprints of the pipeline stacks at their last deployment, kept in a JSON file between CI runs
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            with open(path) as cache:
+                self.fingerprints = json.load(cache)
+        except FileNotFoundError:
+            self.fingerprints = {}
+
+    def is_unchanged(self, stack_name: str, stack_fingerprint: str) -> bool:
+        return self.fingerprints.get(stack_name) == stack_fingerprint
+
+    def update(self, stack_name: str, stack_fingerprint: str):
+        self.fingerprints[stack_name] = stack_fingerprint
+
+    def save(self):
+        with open(self.path, 'w') as cache:
+            json.dump(self.fingerprints, cache, indent=2, sort_keys=True)
+
+
+def changed_stacks(service_map: Dict[str, ServiceMapEntry], shards: int, path: str) -> List[str]:
+    """
+    Names of the pipeline stacks whose fingerprint differs from the recorded one, the ones synth keeps
+    """
+    fingerprint_cache = FingerprintCache(path)
+    return [pipeline_stack_name(shard, shards) for shard, shard_map in enumerate(shard_service_map(service_map, shards))
+            if not fingerprint_cache.is_unchanged(pipeline_stack_name(shard, shards), fingerprint(shard_map))]
+
+
+def record_fingerprints(service_map: Dict[str, ServiceMapEntry], shards: int, path: str) -> FingerprintCache:
+    """
+    Stores the fingerprints of every pipeline stack. Only run once the stacks are deployed: synth (cdk diff, a
+    failed deployment) must not mark a stack as up to date.
+    """
+    fingerprint_cache = FingerprintCache(path)
+    for shard, shard_map in enumerate(shard_service_map(service_map, shards)):
+        fingerprint_cache.update(pipeline_stack_name(shard, shards), fingerprint(shard_map))
+    fingerprint_cache.save()
+    return fingerprint_cache
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record the fingerprints of the deployed pipeline stacks')
+    parser.add_argument('--shards', type=int, default=1, help='pipelineShards of the deployment')
+    parser.add_argument('--cache', default=DEFAULT_FINGERPRINT_CACHE, help='pipelineCache of the deployment')
+    parser.add_argument('--list-changed', action='store_true',
+                        help='only print the stacks whose definitions changed since the recorded fingerprints')
+    args = parser.parse_args()
+    import monorepo_config
+    service_map = collect_service_map(monorepo_config.service_map)
+    if args.list_changed:
+        print('\n'.join(changed_stacks(service_map, args.shards, args.cache)))
+    else:
+        recorded = record_fingerprints(service_map, args.shards, args.cache)
+        print(f'{len(recorded.fingerprints)} pipeline stack fingerprints recorded in {args.cache}')
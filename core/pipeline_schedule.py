@@ -0,0 +1,36 @@
+"""
+Compiles the priority() and weight() of the ServicePipeline classes of monorepo_config.service_map into the
+schedule artifact read by the trigger lambda (core/lambda/pipeline_scheduler.py). Only the pipelines with a
+non-default priority or weight are listed:
+    {"version": 1, "pipelines": {"codepipeline-hotfix-main": {"priority": 100, "weight": 1}}}
+"""
+from typing import Dict
+
+from core.pipeline_registry import ServiceMapEntry, load_service_pipeline
+
+ARTIFACT_NAME = 'pipeline-schedule.json'
+ARTIFACT_VERSION = 1
+ARTIFACT_KEY = 'pipelines'
+DEFAULT_PRIORITY = 0
+DEFAULT_WEIGHT = 1
+
+
+def build_schedule(service_map: Dict[str, ServiceMapEntry]) -> Dict[str, dict]:
+    """
+    Returns {pipeline name: {'priority': int, 'weight': int}}. Raises ValueError listing the pipelines whose
+    priority is not an integer or whose weight is not a positive integer.
+    """
+    schedule = {}
+    errors = []
+    for dir_name, entry in service_map.items():
+        service_pipeline = load_service_pipeline(entry)
+        priority, weight = service_pipeline.priority(), service_pipeline.weight()
+        if not isinstance(priority, int) or isinstance(priority, bool):
+            errors.append(f'{dir_name}: invalid priority {priority!r}')
+        elif not isinstance(weight, int) or isinstance(weight, bool) or weight < 1:
+            errors.append(f'{dir_name}: invalid weight {weight!r}')
+        elif (priority, weight) != (DEFAULT_PRIORITY, DEFAULT_WEIGHT):
+            schedule[service_pipeline.pipeline_name()] = {'priority': priority, 'weight': weight}
+    if errors:
+        raise ValueError('invalid pipeline schedule:\n' + '\n'.join(errors))
+    return dict(sorted(schedule.items()))
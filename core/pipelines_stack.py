@@ -1,10 +1,15 @@
 from aws_cdk import (Stack,
                      aws_codecommit as codecommit)
 from constructs import Construct
+from core.pipeline_registry import load_service_pipeline
 import monorepo_config
 
 class PipelineStack(Stack):
-    def __init__(self, scope: Construct, construct_id: str, codecommit: codecommit, **kwargs) -> None:
+    def __init__(self, scope: Construct, construct_id: str, codecommit: codecommit, service_map=None, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
-        for dir_name, service_pipeline in monorepo_config.service_map.items():
+        # Pipelines of this stack (all of monorepo_config.service_map by default), imported only when built
+        if service_map is None:
+            service_map = monorepo_config.service_map
+        for dir_name, entry in service_map.items():
+            service_pipeline = load_service_pipeline(entry)
             service_pipeline.build_pipeline(self, codecommit, service_pipeline.pipeline_name(), dir_name)
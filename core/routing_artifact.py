@@ -0,0 +1,47 @@
+"""
+Generates the routing artifact of the trigger lambda from monorepo_config.service_map at synth time:
+the pipeline map of each branch ({rule: [pipeline names]}), validated against the pipelines defined
+by the ServicePipeline classes, and bundled with the lambda code so that it is loaded without reading CodeCommit.
+    {"version": 1, "branches": {"main": {"demo": ["codepipeline-demo-main"], ...}}}
+"""
+from typing import Dict, List
+
+from core.pipeline_registry import ServiceMapEntry, load_service_pipeline
+
+ARTIFACT_NAME = 'routing.json'
+ARTIFACT_VERSION = 1
+ARTIFACT_KEY = 'branches'
+DEFAULT_BRANCH = 'main'
+
+
+def build_pipeline_maps(service_map: Dict[str, ServiceMapEntry],
+                        service_dependencies: Dict[str, List[str]] = None) -> Dict[str, Dict[str, List[str]]]:
+    """
+    Returns {branch: {rule: [pipeline names]}}, the branch of a pipeline being its 'branch' attribute ('main'
+    by default). Raises ValueError listing every inconsistency: a pipeline without name, a pipeline name used
+    by two services, a service depending on others without being in service_map.
+    """
+    pipeline_maps = {}
+    owners = {}
+    errors = []
+    for dir_name, entry in service_map.items():
+        rule = dir_name.strip('/')
+        service_pipeline = load_service_pipeline(entry)
+        pipeline_name = service_pipeline.pipeline_name()
+        if not isinstance(pipeline_name, str) or not pipeline_name:
+            errors.append(f'{dir_name}: invalid pipeline name {pipeline_name!r}')
+            continue
+        if pipeline_name in owners:
+            errors.append(f'{dir_name}: pipeline {pipeline_name} is already used by {owners[pipeline_name]}')
+            continue
+        owners[pipeline_name] = dir_name
+        branch = getattr(service_pipeline, 'branch', DEFAULT_BRANCH)
+        pipeline_maps.setdefault(branch, {}).setdefault(rule, []).append(pipeline_name)
+
+    services = {dir_name.strip('/') for dir_name in service_map}
+    for dir_name in service_dependencies or {}:
+        if dir_name.strip('/') not in services:
+            errors.append(f'service_dependencies: {dir_name} is not a service of service_map')
+    if errors:
+        raise ValueError('invalid monorepo configuration:\n' + '\n'.join(errors))
+    return {branch: dict(sorted(pipeline_map.items())) for branch, pipeline_map in sorted(pipeline_maps.items())}
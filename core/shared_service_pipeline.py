@@ -0,0 +1,104 @@
+from abc import abstractmethod
+from typing import List
+from aws_cdk import (RemovalPolicy, Stack,
+                     aws_codebuild as codebuild,
+                     aws_codepipeline as codepipeline,
+                     aws_codepipeline_actions as codepipeline_actions,
+                     aws_codecommit as codecommit,
+                     aws_s3 as s3)
+from constructs import Construct
+from core.abstract_service_pipeline import ServicePipeline
+
+SELECT_PROJECT_ID = 'SharedSelectServiceArtifact'
+ARTIFACT_BUCKET_ID = 'SharedPipelineArtifacts'
+
+
+class SharedServicePipeline(ServicePipeline):
+    """
+    Parameterised service pipeline: Source -> SelectServiceArtifact -> stages of deploy_stages().
+
+    The Source stage only outputs a reference to the commit (CodeBuild clone output) instead of a zip of the whole
+    monorepo, and the Build stage packages the service directory alone. The CodeBuild project selecting the
+    directory and the artifact bucket are created once per stack and shared by its pipelines: the service
+    directory is passed as the SERVICE_DIR environment variable override of each pipeline.
+    """
+    branch = 'main'
+
+    @abstractmethod
+    def deploy_stages(self, scope: Construct, service_artifact: codepipeline.Artifact, pipeline_name: str,
+                      service_name: str) -> List[codepipeline.StageProps]:
+        pass
+
+    def build_pipeline(self, scope: Construct, code_commit: codecommit.Repository, pipeline_name: str,
+                       service_name: str):
+        source_output = codepipeline.Artifact()
+        service_artifact = codepipeline.Artifact()
+
+        source_stage = codepipeline.StageProps(stage_name="Source",
+                                               actions=[codepipeline_actions.CodeCommitSourceAction(
+                                                   action_name="CodeCommit_Source",
+                                                   branch=self.branch,
+                                                   repository=code_commit,
+                                                   output=source_output,
+                                                   code_build_clone_output=True,
+                                                   trigger=codepipeline_actions.CodeCommitTrigger.NONE)])
+        build_stage = codepipeline.StageProps(stage_name="Build",
+                                              actions=[codepipeline_actions.CodeBuildAction(
+                                                  action_name="SelectServiceArtifact",
+                                                  project=shared_select_project(scope),
+                                                  input=source_output,
+                                                  outputs=[service_artifact],
+                                                  environment_variables={
+                                                      'SERVICE_DIR': codebuild.BuildEnvironmentVariable(
+                                                          value=service_name)})])
+
+        return codepipeline.Pipeline(scope, pipeline_name,
+                                     pipeline_name=pipeline_name,
+                                     artifact_bucket=shared_artifact_bucket(scope),
+                                     cross_account_keys=False,
+                                     stages=[source_stage, build_stage,
+                                             *self.deploy_stages(scope, service_artifact, pipeline_name,
+                                                                 service_name)])
+
+
+def shared_select_project(scope: Construct) -> codebuild.PipelineProject:
+    """
+    CodeBuild project of the stack packaging the SERVICE_DIR directory of the cloned commit.
+    The directory is moved (not copied) out of the clone, it becomes the root of the output artifact.
+    """
+    stack = Stack.of(scope)
+    project = stack.node.try_find_child(SELECT_PROJECT_ID)
+    if project is None:
+        project = codebuild.PipelineProject(stack, SELECT_PROJECT_ID,
+                                            build_spec=codebuild.BuildSpec.from_object(dict(
+                                                version='0.2',
+                                                env={'git-credential-helper': 'yes'},
+                                                phases=dict(
+                                                    build=dict(
+                                                        commands=[
+                                                            'echo selecting directory $SERVICE_DIR...',
+                                                            'test -d "$SERVICE_DIR"',
+                                                            'mv "$SERVICE_DIR"'
+                                                            ' "$CODEBUILD_SRC_DIR/.service-artifact"'])),
+                                                artifacts={
+                                                    'base-directory': '.service-artifact',
+                                                    'files': ['**/*']})),
+                                            environment=dict(build_image=codebuild.LinuxBuildImage.STANDARD_5_0,
+                                                             compute_type=codebuild.ComputeType.SMALL))
+    return project
+
+
+def shared_artifact_bucket(scope: Construct) -> s3.Bucket:
+    """
+    Artifact bucket of the stack, shared by its pipelines (objects are prefixed by pipeline name)
+    """
+    stack = Stack.of(scope)
+    bucket = stack.node.try_find_child(ARTIFACT_BUCKET_ID)
+    if bucket is None:
+        bucket = s3.Bucket(stack, ARTIFACT_BUCKET_ID,
+                           block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+                           encryption=s3.BucketEncryption.S3_MANAGED,
+                           enforce_ssl=True,
+                           auto_delete_objects=True,
+                           removal_policy=RemovalPolicy.DESTROY)
+    return bucket
@@ -1,16 +1,21 @@
 # This is a configuration file is used by PipelineStack to determine which pipelines should be constructed
 
 from core.abstract_service_pipeline import ServicePipeline
-from typing import Dict
+from typing import Dict, List, Union
 
 
-# Pipeline definition imports
-from pipelines.pipeline_demo import DemoPipeline
-from pipelines.pipeline_hotsite import HotsitePipeline
-
 ### Add your pipeline configuration here
-service_map: Dict[str, ServicePipeline]  = {
-    # folder-name -> pipeline-class
-    'demo': DemoPipeline(),
-    'hotsite': HotsitePipeline()
-}
\ No newline at end of file
+# Pipeline classes are referenced by module path (a ServicePipeline instance is accepted as well). MonoRepoStack
+# imports and instantiates them to compile the trigger artifacts, their constructs are built by their own stack
+service_map: Dict[str, Union[ServicePipeline, str]] = {
+    # folder-name -> 'module.path:PipelineClass'
+    'demo': 'pipelines.pipeline_demo:DemoPipeline',
+    'hotsite': 'pipelines.pipeline_hotsite:HotsitePipeline'
+}
+
+### Declare here the directories each service depends on (shared libraries, other services)
+# A change under a dependency also triggers the pipelines of the services depending on it, transitively
+service_dependencies: Dict[str, List[str]] = {
+    # folder-name -> [dependency folder-names]
+    # 'hotsite': ['libs/ui'],
+}
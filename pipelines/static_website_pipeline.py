@@ -0,0 +1,54 @@
+from core.shared_service_pipeline import SharedServicePipeline
+from aws_cdk import (RemovalPolicy, CfnOutput,
+                     aws_iam as iam,
+                     aws_codepipeline as codepipeline,
+                     aws_codepipeline_actions as codepipeline_actions,
+                     aws_s3 as s3,
+                     aws_cloudfront as cloudfront)
+from constructs import Construct
+
+
+class StaticWebsitePipeline(SharedServicePipeline):
+    """
+    Deploys the directory of a service as a static website (S3 bucket behind CloudFront).
+    Subclasses only define pipeline_name().
+    """
+
+    def deploy_stages(self, scope: Construct, service_artifact: codepipeline.Artifact, pipeline_name: str,
+                      service_name: str):
+        bucket = s3.Bucket(
+            scope,
+            f'Bucket-{pipeline_name}-{service_name}',
+            block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+            website_index_document='index.html',
+            website_error_document='error.html',
+            auto_delete_objects=True,
+            removal_policy=RemovalPolicy.DESTROY)
+
+        cloudfront_oai = cloudfront.OriginAccessIdentity(scope, f"Cloudfront OAI for {service_name}")
+
+        bucket.add_to_resource_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=["s3:GetObject"],
+            principals=[iam.CanonicalUserPrincipal(
+                cloudfront_oai.cloud_front_origin_access_identity_s3_canonical_user_id)],
+            resources=[bucket.arn_for_objects("*")]
+        ))
+
+        s3_origin_source = cloudfront.S3OriginConfig(s3_bucket_source=bucket, origin_access_identity=cloudfront_oai)
+        source_config = cloudfront.SourceConfiguration(s3_origin_source=s3_origin_source, behaviors=[
+            cloudfront.Behavior(is_default_behavior=True)])
+
+        dist = cloudfront.CloudFrontWebDistribution(scope,
+                                                    service_name,
+                                                    origin_configs=[source_config],
+                                                    comment='CDK created',
+                                                    default_root_object="index.html")
+
+        CfnOutput(scope, f'{service_name}_url', value=dist.distribution_domain_name,
+                      export_name=f'{service_name}-url')
+
+        return [codepipeline.StageProps(stage_name="Deploy",
+                                        actions=[codepipeline_actions.S3DeployAction(action_name="DeployS3",
+                                                                                     bucket=bucket,
+                                                                                     input=service_artifact)])]
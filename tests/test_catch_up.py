@@ -0,0 +1,69 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'core', 'lambda'))
+
+import catch_up  # noqa: E402
+
+# First-parent history c0 <- c1 <- ... <- c10
+COMMITS = [f'c{index}' for index in range(11)]
+PARENTS = dict(zip(COMMITS, [None, *COMMITS]))
+
+
+@pytest.fixture
+def history(monkeypatch):
+    monkeypatch.setattr(catch_up, 'get_parent_commit', lambda repository, commit_id: PARENTS[commit_id])
+    monkeypatch.setattr(catch_up, 'CATCH_UP_CHUNK_COMMITS', 4)
+    monkeypatch.setattr(catch_up, 'CATCH_UP_MAX_COMMITS', 2000)
+
+
+def test_chunks_end_at_the_head(history):
+    assert catch_up.plan_catch_up_chunks('repo', 'c10', 'c0') == ([('c0', 'c4'), ('c4', 'c8'), ('c8', 'c10')], None)
+
+
+def test_chunks_on_an_exact_multiple(history):
+    assert catch_up.plan_catch_up_chunks('repo', 'c8', 'c0') == ([('c0', 'c4'), ('c4', 'c8')], None)
+
+
+def test_single_chunk_when_last_commit_is_unknown(history):
+    assert catch_up.plan_catch_up_chunks('repo', 'c10', None) == ([('c9', 'c10')], None)
+
+
+def test_no_chunk_when_up_to_date(history):
+    assert catch_up.plan_catch_up_chunks('repo', 'c10', 'c10') == ([], None)
+
+
+def test_walk_stops_at_the_oldest_commit_walked(history, monkeypatch):
+    monkeypatch.setattr(catch_up, 'CATCH_UP_MAX_COMMITS', 3)
+    assert catch_up.plan_catch_up_chunks('repo', 'c10', 'c0') == (None, 'c8')
+
+
+def test_last_commit_not_a_first_parent_ancestor(history):
+    with pytest.raises(ValueError):
+        catch_up.plan_catch_up_chunks('repo', 'c10', 'rewritten')
+
+
+def test_branch_caught_up_through_intermediate_targets(history, monkeypatch):
+    monkeypatch.setattr(catch_up, 'CATCH_UP_MAX_COMMITS', 3)
+    ranges = []
+
+    def collect_matched_rules(repository, commit_id, branch_name, last_commit, metrics=None):
+        ranges.append((last_commit, commit_id))
+        return set(), None
+
+    monkeypatch.setattr(catch_up, 'get_stored_last_commit', lambda repository, branch_name: 'c0')
+    monkeypatch.setattr(catch_up, 'collect_matched_rules', collect_matched_rules)
+    monkeypatch.setattr(catch_up, 'resolve_pipeline_names', lambda matched_rules, router: [])
+    monkeypatch.setattr(catch_up, 'trigger_pipelines', lambda *args: None)
+    monkeypatch.setattr(catch_up, 'update_last_commit', lambda *args: None)
+
+    result = catch_up.catch_up_branch('repo', 'main', 'c10')
+
+    # Each walk of 3 commits (the target included) pushes the next target: c8, c6, c4 and c2. The branch is then
+    # caught up to the oldest target first, one range per target
+    assert result['status'] == 'complete'
+    assert result['last_commit'] == 'c10'
+    assert ranges == [('c0', 'c2'), ('c2', 'c4'), ('c4', 'c6'), ('c6', 'c8'), ('c8', 'c10')]
+    assert result['targets'] == []
@@ -0,0 +1,41 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'core', 'lambda'))
+
+import handler  # noqa: E402
+from pipeline_router import PipelineRouter  # noqa: E402
+
+ROUTER = PipelineRouter({'svc': 'codepipeline-svc', 'services/*/worker': 'codepipeline-workers'})
+
+
+def difference(before=None, after=None):
+    return {'beforeBlob': {'path': before[0], 'blobId': before[1]} if before else None,
+            'afterBlob': {'path': after[0], 'blobId': after[1]} if after else None}
+
+
+def match(differences):
+    return handler.match_content_changes(ROUTER, handler.sum_dir_digests(handler.iter_blob_digests(differences)))
+
+
+def test_swapped_contents_trigger():
+    assert match([difference(('svc/x', 'a1'), ('svc/x', 'b2')),
+                  difference(('svc/y', 'b2'), ('svc/y', 'a1'))]) == ({'svc'}, set())
+
+
+def test_renamed_file_triggers():
+    assert match([difference(('svc/index.html', 'a1'), ('svc/home.html', 'a1'))]) == ({'svc'}, set())
+
+
+def test_moved_file_between_directories_triggers():
+    assert match([difference(('svc/a/file', 'a1'), ('svc/b/file', 'a1'))]) == ({'svc'}, set())
+
+
+def test_mode_change_does_not_trigger():
+    assert match([difference(('svc/run.sh', 'a1'), ('svc/run.sh', 'a1'))]) == (set(), {'svc'})
+
+
+def test_swapped_contents_across_wildcard_services_trigger():
+    assert match([difference(('services/a/worker/src/main.py', 'a1'), ('services/a/worker/src/main.py', 'b2')),
+                  difference(('services/b/worker/src/main.py', 'b2'), ('services/b/worker/src/main.py', 'a1'))]) \
+        == ({'services/*/worker'}, set())
@@ -0,0 +1,50 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'core', 'lambda'))
+
+from pipeline_router import PipelineRouter  # noqa: E402
+
+
+def test_longest_prefix_wins():
+    router = PipelineRouter({'services': 'all', 'services/payments': 'payments', 'services/payments/api': 'api'})
+    assert router.match_dir('services/payments/api/src') == ('services/payments/api',)
+    assert router.match_dir('services/payments/web') == ('services/payments',)
+    assert router.match_dir('services') == ('services',)
+    assert router.match_dir('docs') == ()
+
+
+def test_literal_wins_over_wildcard_at_the_same_depth():
+    router = PipelineRouter({'services/*': 'any', 'services/payments': 'payments'})
+    assert router.match_dir('services/payments/src') == ('services/payments',)
+    assert router.match_dir('services/orders/src') == ('services/*',)
+
+
+def test_star_matches_one_directory():
+    router = PipelineRouter({'services/*/worker': 'workers', 'services/w?b': 'web'})
+    assert router.match_dir('services/a/worker/src') == ('services/*/worker',)
+    assert router.match_dir('services/a/b/worker') == ()
+    assert router.match_dir('services/web') == ('services/w?b',)
+
+
+def test_globstar_matches_any_number_of_directories():
+    router = PipelineRouter({'libs': 'libs', 'libs/**/common': 'common', 'shared/**': 'shared'})
+    assert router.match_dir('libs/common') == ('libs/**/common',)
+    assert router.match_dir('libs/a/b/common/src') == ('libs/**/common',)
+    assert router.match_dir('libs/a/b') == ('libs',)
+    # A trailing '**' is the directory itself
+    assert router.match_dir('shared') == ('shared/**',)
+    assert router.match_dir('shared/a/b') == ('shared/**',)
+
+
+def test_rules_of_the_same_specificity_all_win():
+    router = PipelineRouter({'services/*/worker': ['workers', 'audit'], 'services/a/*': 'a'})
+    assert set(router.match_dir('services/a/worker')) == {'services/*/worker', 'services/a/*'}
+    assert router.match_dir('services/b/worker') == ('services/*/worker',)
+    assert router.pipeline_names(router.match_dir('services/a/worker')) == ['workers', 'audit', 'a']
+
+
+def test_root_files_never_match():
+    router = PipelineRouter({'**': 'everything'})
+    assert router.match('README.md') == ()
+    assert router.match('docs/README.md') == ('**',)
@@ -0,0 +1,63 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'core', 'lambda'))
+
+from last_commit_store import InMemoryLastCommitStore  # noqa: E402
+from pipeline_scheduler import InFlightLedger, PipelineSchedule  # noqa: E402
+
+SCHEDULE = PipelineSchedule({'hotfix': {'priority': 100, 'weight': 2},
+                             'big': {'priority': 50, 'weight': 3},
+                             'heavy': {'weight': 5}})
+
+
+def ledger(budget=3, ttl=3600):
+    return InFlightLedger(InMemoryLastCommitStore(), SCHEDULE, budget, ttl=ttl)
+
+
+def test_admitted_by_priority():
+    assert ledger(budget=6).admit(['small', 'big', 'hotfix']) == (['hotfix', 'big', 'small'], [])
+
+
+def test_lower_priorities_held_behind_a_held_pipeline():
+    # small fits in the budget left by hotfix, but would keep taking the budget big is waiting for
+    assert ledger().admit(['small', 'big', 'hotfix']) == (['hotfix'], ['big', 'small'])
+
+
+def test_running_pipeline_admitted_without_more_budget():
+    in_flight = ledger()
+    assert in_flight.admit(['big']) == (['big'], [])
+    assert in_flight.admit(['big']) == (['big'], [])
+    assert in_flight.used() == 3
+
+
+def test_over_weight_pipeline_admitted_when_nothing_runs():
+    in_flight = ledger()
+    assert in_flight.admit(['heavy']) == (['heavy'], [])
+    assert in_flight.admit(['small']) == ([], ['small'])
+
+
+def test_over_weight_pipeline_held_while_another_runs():
+    in_flight = ledger()
+    in_flight.admit(['small'])
+    assert in_flight.admit(['heavy']) == ([], ['heavy'])
+
+
+def test_record_and_release():
+    in_flight = ledger()
+    in_flight.admit(['hotfix', 'small'])
+    # The reservation of a failed start is released
+    in_flight.record({'hotfix': 'execution-1', 'small': None})
+    assert {name: entry[2] for name, entry in in_flight.entries().items()} == {'hotfix': 'execution-1'}
+
+    assert not in_flight.release('hotfix', 'execution-0')
+    assert in_flight.release('hotfix', 'execution-1')
+    assert in_flight.used() == 0
+    assert not in_flight.release('hotfix', 'execution-1')
+
+
+def test_expired_entries_release_their_budget():
+    in_flight = ledger(ttl=0)
+    in_flight.admit(['big'])
+    assert in_flight.used() == 0
+    assert in_flight.admit(['hotfix']) == (['hotfix'], [])
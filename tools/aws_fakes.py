@@ -0,0 +1,140 @@
+"""
+API fakes shared by the offline tools (tools/local_emulator.py and tools/benchmark_trigger.py): the call counter
+with injected latency, the error raised by the fakes (same response shape as botocore's ClientError), and the
+SSM and CodePipeline clients. The CodeCommit fakes stay in each tool, a git-backed one in the emulator and a
+synthetic diff in the benchmark.
+"""
+import itertools
+import random
+import threading
+import time
+
+
+class EmulatorError(Exception):
+    def __init__(self, code, message=''):
+        super().__init__(f'{code}: {message}' if message else code)
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+
+def error_class(code):
+    def __init__(self, message=''):
+        EmulatorError.__init__(self, code, message)
+    return type(code, (EmulatorError,), {'__init__': __init__})
+
+
+class ApiCounter:
+    """
+    Thread-safe count of the calls per operation, with optional injected latency
+    """
+
+    def __init__(self, latency_ms=0.0):
+        self.latency = latency_ms / 1000
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, operation):
+        with self._lock:
+            self.counts[operation] = self.counts.get(operation, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class LocalSsm:
+
+    class exceptions:
+        ClientError = EmulatorError
+        ParameterAlreadyExists = error_class('ParameterAlreadyExists')
+        ParameterNotFound = error_class('ParameterNotFound')
+
+    def __init__(self, calls=None, parameters=None):
+        self.calls = calls or ApiCounter()
+        self.parameters = dict(parameters or {})
+        self._lock = threading.Lock()
+
+    def get_parameters(self, Names, **kwargs):
+        self.calls('ssm:GetParameters')
+        if len(Names) > 10:
+            raise EmulatorError('ValidationException', 'at most 10 names')
+        with self._lock:
+            return {'Parameters': [{'Name': name, 'Value': self.parameters[name]}
+                                   for name in Names if name in self.parameters],
+                    'InvalidParameters': [name for name in Names if name not in self.parameters]}
+
+    def get_parameter(self, Name, **kwargs):
+        self.calls('ssm:GetParameter')
+        with self._lock:
+            if Name not in self.parameters:
+                raise self.exceptions.ParameterNotFound(Name)
+            return {'Parameter': {'Name': Name, 'Value': self.parameters[Name]}}
+
+    def put_parameter(self, Name, Value, Overwrite=False, **kwargs):
+        self.calls('ssm:PutParameter')
+        with self._lock:
+            if Name in self.parameters and not Overwrite:
+                raise self.exceptions.ParameterAlreadyExists(Name)
+            self.parameters[Name] = Value
+        return {'Version': 1}
+
+
+class LocalCodePipeline:
+    """
+    Pipelines known by name (every name when pipeline_names is None). An execution stays in progress for
+    execution_seconds, with the head of `branch` at start as source revision. throttle_rate is the share of
+    start_pipeline_execution calls failing with ThrottlingException.
+    """
+
+    class exceptions:
+        ClientError = EmulatorError
+        PipelineNotFoundException = error_class('PipelineNotFoundException')
+
+    def __init__(self, pipeline_names=None, calls=None, codecommit=None, branch='main', execution_seconds=0.0,
+                 throttle_rate=0.0, seed=0):
+        self.pipeline_names = set(pipeline_names) if pipeline_names is not None else None
+        self.calls = calls or ApiCounter()
+        self.codecommit = codecommit
+        self.branch = branch
+        self.execution_seconds = execution_seconds
+        self.throttle_rate = throttle_rate
+        self.executions = []
+        self._random = random.Random(seed)
+        self._execution_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _check(self, name):
+        if self.pipeline_names is not None and name not in self.pipeline_names:
+            raise self.exceptions.PipelineNotFoundException(name)
+
+    def start_pipeline_execution(self, name, **kwargs):
+        self.calls('codepipeline:StartPipelineExecution')
+        self._check(name)
+        with self._lock:
+            if self.throttle_rate and self._random.random() < self.throttle_rate:
+                raise EmulatorError('ThrottlingException', name)
+            execution_id = f'execution-{next(self._execution_ids)}'
+        revision = self.codecommit.resolve_commit(self.branch) if self.codecommit else None
+        with self._lock:
+            self.executions.append({'name': name, 'id': execution_id, 'revision': revision,
+                                    'started_at': time.monotonic()})
+        return {'pipelineExecutionId': execution_id}
+
+    def get_pipeline_state(self, name, **kwargs):
+        self.calls('codepipeline:GetPipelineState')
+        self._check(name)
+        with self._lock:
+            latest = next((execution for execution in reversed(self.executions) if execution['name'] == name), None)
+        if latest is None:
+            return {'pipelineName': name, 'stageStates': []}
+        running = time.monotonic() - latest['started_at'] < self.execution_seconds
+        return {'pipelineName': name, 'stageStates': [
+            {'stageName': 'Source',
+             'latestExecution': {'pipelineExecutionId': latest['id'], 'status': 'Succeeded'},
+             'actionStates': [{'actionName': 'CodeCommit_Source',
+                               'currentRevision': {'revisionId': latest['revision']}}]},
+            {'stageName': 'Build',
+             'latestExecution': {'pipelineExecutionId': latest['id'],
+                                 'status': 'InProgress' if running else 'Succeeded'}}]}
+
+    def started(self):
+        with self._lock:
+            return [execution['name'] for execution in self.executions]
+
@@ -0,0 +1,247 @@
+"""
+Offline replay benchmark for the trigger lambda (core/lambda/handler.py).
+
+Replays a recorded CodeCommit push event (--event) or a synthetic one against a stubbed CodeCommit client and
+the SSM and CodePipeline fakes of tools/aws_fakes.py, with injected latency, for every combination of diff size
+and number of services:
+
+    python tools/benchmark_trigger.py --files 10 10000 200000 --services 1 50 500 --latency-ms 20
+
+For each scenario it reports the end-to-end latency of handler.main, the API calls made, and the time and
+peak traced memory of each phase:
+    diff      collect_matched_rules: last commit lookup, get_modified_files_since_last_run and path routing
+              (the diff is lazy, so it is paged while being routed)
+    resolve   resolve_pipeline_names
+    start     start_codepipelines
+Latency is measured in a first run without tracing, memory in a second run with tracemalloc.
+Phase memory is exact for single-branch events; with several branches the phases overlap.
+With --rss, each scenario also runs once in a fresh interpreter, whose peak resident set size (ru_maxrss:
+interpreter, handler module, stubs and the run) is the figure to compare with the Lambda memory size.
+"""
+import argparse
+from contextlib import contextmanager, redirect_stdout
+import copy
+import itertools
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'core', 'lambda'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('LAST_COMMIT_STORE', 'memory')
+
+import handler  # noqa: E402
+from last_commit_store import SsmLastCommitStore  # noqa: E402
+from tools.aws_fakes import ApiCounter, LocalCodePipeline, LocalSsm  # noqa: E402
+
+REPOSITORY = 'monorepo-sample'
+PHASES = {'diff': 'collect_matched_rules', 'resolve': 'resolve_pipeline_names', 'start': 'start_codepipelines'}
+
+
+class StubCodeCommit:
+    """
+    Synthetic diff of `files` modified files spread over the first `touched` of `services` top-level directories,
+    generated page by page (100 differences per page, as CodeCommit does)
+    """
+    PAGE_SIZE = 100
+
+    def __init__(self, calls, files, services, touched):
+        self.calls = calls
+        self.files = files
+        self.touched = touched
+        self.pipeline_map = json.dumps({service_dir(index): pipeline_name(index) for index in range(services)})
+
+    def get_differences(self, repositoryName, afterCommitSpecifier, beforeCommitSpecifier=None, NextToken=None):
+        self.calls('codecommit:GetDifferences')
+        start = int(NextToken or 0)
+        end = min(start + self.PAGE_SIZE, self.files)
+        page = {'differences': [{'changeType': 'M',
+                                 'beforeBlob': {'path': self.path(index), 'blobId': f'{index:040x}'},
+                                 'afterBlob': {'path': self.path(index), 'blobId': f'{index + 1:040x}'}}
+                                for index in range(start, end)]}
+        if end < self.files:
+            page['NextToken'] = str(end)
+        return page
+
+    def path(self, index):
+        return f'{service_dir(index % self.touched)}/src/module{index % 97}/file{index}.py'
+
+    def get_file(self, repositoryName, commitSpecifier, filePath):
+        self.calls('codecommit:GetFile')
+        return {'blobId': 'pipeline-map-blob', 'fileContent': self.pipeline_map.encode()}
+
+    def get_blob(self, repositoryName, blobId):
+        self.calls('codecommit:GetBlob')
+        return {'content': self.pipeline_map.encode()}
+
+    def get_commit(self, repositoryName, commitId):
+        self.calls('codecommit:GetCommit')
+        return {'commit': {'commitId': commitId, 'parents': [f'parent-of-{commitId}']}}
+
+
+def service_dir(index):
+    return f'service{index:03d}'
+
+
+def pipeline_name(index):
+    return f'codepipeline-service{index:03d}-main'
+
+
+def synthetic_event(branch_name='main', commit_id='0' * 40):
+    return {'Records': [{'eventSourceARN': f'arn:aws:codecommit:us-east-1:123456789012:{REPOSITORY}',
+                         'codecommit': {'references': [{'commit': commit_id,
+                                                        'ref': f'{handler.BRANCH_REF_PREFIX}{branch_name}'}]}}]}
+
+
+@contextmanager
+def instrumented_phases(phase_stats, trace_memory):
+    """
+    Wraps the handler phase functions to record their duration and, when tracing, their peak memory
+    above the memory in use when the phase started (the overall traced peak is kept under '_peak')
+    """
+    originals = {phase: getattr(handler, function) for phase, function in PHASES.items()}
+
+    def wrap(phase, function):
+        def timed(*args, **kwargs):
+            if trace_memory:
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+            started_at = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats = phase_stats.setdefault(phase, {'ms': 0.0, 'peak_kib': 0.0})
+                stats['ms'] += (time.perf_counter() - started_at) * 1000
+                if trace_memory:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    stats['peak_kib'] = max(stats['peak_kib'], (peak - baseline) / 1024)
+                    phase_stats['_peak'] = max(phase_stats.get('_peak', 0), peak)
+        return timed
+
+    for phase, function in originals.items():
+        setattr(handler, PHASES[phase], wrap(phase, function))
+    try:
+        yield
+    finally:
+        for phase, function in originals.items():
+            setattr(handler, PHASES[phase], function)
+
+
+def replay(event, files, services, touched, latency_ms, trace_memory=False, warm=False):
+    """
+    Runs handler.main once against fresh stubs and returns its measurements
+    """
+    calls = ApiCounter(latency_ms)
+    handler._clients['codecommit'] = StubCodeCommit(calls, files, services, touched)
+    handler._clients['codepipeline'] = LocalCodePipeline(calls=calls)
+    handler.last_commit_store = SsmLastCommitStore(LocalSsm(calls))
+    if not warm:
+        handler._pipeline_router_cache.clear()
+
+    phase_stats = {}
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with instrumented_phases(phase_stats, trace_memory), open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            started_at = time.perf_counter()
+            handler.main(copy.deepcopy(event), None)
+            total_ms = (time.perf_counter() - started_at) * 1000
+        if trace_memory:
+            peak_kib = max(phase_stats.pop('_peak', 0), tracemalloc.get_traced_memory()[1]) / 1024
+        else:
+            peak_kib = None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return {'total_ms': total_ms, 'peak_kib': peak_kib, 'phases': phase_stats, 'api_calls': calls.counts}
+
+
+def replay_rss_kib(event, files, services, touched, latency_ms):
+    """
+    Runs replay once and returns the peak resident set size of the process in KiB
+    """
+    import resource
+    replay(event, files, services, touched, latency_ms)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 if sys.platform == 'darwin' else rss
+
+
+def peak_rss_kib(event, files, services, touched, latency_ms):
+    """
+    replay_rss_kib in a fresh interpreter, so that neither the earlier scenarios nor tracemalloc weigh on it
+    """
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(replay_rss_kib, (event, files, services, touched, latency_ms))
+
+
+def run_scenario(event, files, services, touched_ratio, latency_ms, repeat, warm, rss=False):
+    # Services left untouched keep the diff walk from stopping early, so the whole diff is paged
+    touched = max(1, min(services, round(services * touched_ratio)))
+    runs = [replay(event, files, services, touched, latency_ms, warm=warm) for _ in range(repeat)]
+    memory = replay(event, files, services, touched, latency_ms, trace_memory=True, warm=warm)
+    return {
+        'files': files,
+        'services': services,
+        'touched_services': touched,
+        'latency_ms': latency_ms,
+        'total_ms': statistics.median(run['total_ms'] for run in runs),
+        'phases': {phase: {'ms': statistics.median(run['phases'].get(phase, {}).get('ms', 0.0) for run in runs),
+                           'peak_kib': memory['phases'].get(phase, {}).get('peak_kib', 0.0)}
+                   for phase in PHASES},
+        'peak_kib': memory['peak_kib'],
+        'peak_rss_kib': peak_rss_kib(event, files, services, touched, latency_ms) if rss else None,
+        'api_calls': runs[-1]['api_calls'],
+    }
+
+
+def format_result(result):
+    phases = '  '.join(f"{phase} {stats['ms']:9.1f}ms {stats['peak_kib']:9.1f}KiB"
+                       for phase, stats in result['phases'].items())
+    calls = ', '.join(f'{operation}={count}' for operation, count in sorted(result['api_calls'].items()))
+    rss = f"rss {result['peak_rss_kib'] / 1024:6.1f}MiB  " if result['peak_rss_kib'] is not None else ''
+    return (f"files={result['files']:<7} services={result['services']:<4} touched={result['touched_services']:<4} "
+            f"total {result['total_ms']:9.1f}ms peak {result['peak_kib']:9.1f}KiB  {rss}{phases}  [{calls}]")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--event', help='recorded CodeCommit event (JSON), a synthetic push to main by default')
+    parser.add_argument('--files', type=int, nargs='+', default=[10, 1000, 10000, 100000, 200000],
+                        help='number of modified files in the diff')
+    parser.add_argument('--services', type=int, nargs='+', default=[1, 50, 500],
+                        help='number of services (top-level directories) in the pipeline map')
+    parser.add_argument('--touched-ratio', type=float, default=0.5,
+                        help='share of the services modified by the diff (1.0 lets the diff walk stop early)')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='latency injected in every API call')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per scenario (median reported)')
+    parser.add_argument('--warm', action='store_true', help='keep the pipeline map cache between runs')
+    parser.add_argument('--rss', action='store_true', help='also report the peak RSS of a fresh interpreter')
+    parser.add_argument('--json', metavar='FILE', help='also write the results as JSON to FILE')
+    args = parser.parse_args(argv)
+
+    if args.event:
+        with open(args.event) as event_file:
+            event = json.load(event_file)
+    else:
+        event = synthetic_event()
+
+    results = []
+    for files, services in itertools.product(args.files, args.services):
+        result = run_scenario(event, files, services, args.touched_ratio, args.latency_ms, args.repeat, args.warm,
+                              args.rss)
+        print(format_result(result), flush=True)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,355 @@
+"""
+In-process emulator of the CodeCommit, SSM and CodePipeline APIs used by the trigger lambda (core/lambda/handler.py),
+backed by a local git repository, to run the handler end-to-end without AWS.
+
+    aws = LocalAws('/tmp/monorepo.git')
+    generate_history(aws.repo_path, services=200, commits=500, files_per_commit=50)
+    aws.install(handler)
+    handler.main(aws.push_event('main'), None)
+
+CodeCommit: get_differences (paginated like CodeCommit, NextToken and MaxResults), get_file, get_blob, get_branch
+and get_commit, answered with git plumbing commands. SSM: get_parameter(s) and put_parameter. CodePipeline:
+start_pipeline_execution and get_pipeline_state, executions staying in progress for execution_seconds.
+The SSM and CodePipeline fakes, the call counter and EmulatorError (same response shape as botocore's
+ClientError) live in tools/aws_fakes.py.
+
+Run as a script, it generates a history and replays pushes on several branches, directly or through the FIFO
+queue stand-in (tools/local_fifo_queue.py):
+
+    python tools/local_emulator.py --repo /tmp/monorepo.git --services 200 --commits 200 --files-per-commit 100 \\
+        --branches 4 --pushes 20 --queue --pollers 4
+"""
+import argparse
+from collections import OrderedDict
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPOSITORY = 'monorepo-local'
+EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+sys.path.insert(0, ROOT_DIR)
+
+from tools.aws_fakes import ApiCounter, EmulatorError, LocalCodePipeline, LocalSsm, error_class  # noqa: E402
+
+
+class LocalCodeCommit:
+    """
+    CodeCommit over a local (bare or not) git repository. The raw diff of a commit range is computed once and
+    kept in a small LRU cache, so paging through it does not run git again.
+    """
+    PAGE_SIZE = 100
+
+    class exceptions:
+        ClientError = EmulatorError
+        CommitDoesNotExistException = error_class('CommitDoesNotExistException')
+        BranchDoesNotExistException = error_class('BranchDoesNotExistException')
+        FileDoesNotExistException = error_class('FileDoesNotExistException')
+        BlobIdDoesNotExistException = error_class('BlobIdDoesNotExistException')
+        InvalidContinuationTokenException = error_class('InvalidContinuationTokenException')
+
+    def __init__(self, repo_path, calls=None, cached_diffs=8):
+        self.repo_path = repo_path
+        self.calls = calls or ApiCounter()
+        self._diffs = OrderedDict()
+        self._cached_diffs = cached_diffs
+        self._lock = threading.Lock()
+
+    def git(self, *args, input=None) -> bytes:
+        return subprocess.run(['git', '-C', self.repo_path, *args], input=input, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout
+
+    def resolve_commit(self, commit_specifier: str) -> str:
+        try:
+            return self.git('rev-parse', '--verify', '--quiet', f'{commit_specifier}^{{commit}}').decode().strip()
+        except subprocess.CalledProcessError:
+            raise self.exceptions.CommitDoesNotExistException(commit_specifier)
+
+    def get_differences(self, repositoryName, afterCommitSpecifier, beforeCommitSpecifier=None, NextToken=None,
+                        MaxResults=None, **kwargs):
+        self.calls('codecommit:GetDifferences')
+        after = self.resolve_commit(afterCommitSpecifier)
+        before = self.resolve_commit(beforeCommitSpecifier) if beforeCommitSpecifier else None
+        differences = self._differences(before, after)
+        try:
+            start = int(NextToken or 0)
+        except ValueError:
+            raise self.exceptions.InvalidContinuationTokenException(NextToken)
+        end = min(start + (MaxResults or self.PAGE_SIZE), len(differences))
+        page = {'differences': differences[start:end]}
+        if end < len(differences):
+            page['NextToken'] = str(end)
+        return page
+
+    def _differences(self, before, after):
+        key = (before, after)
+        with self._lock:
+            if key in self._diffs:
+                self._diffs.move_to_end(key)
+                return self._diffs[key]
+        # CodeCommit reports additions, deletions and modifications only (renames are a deletion and an addition)
+        raw = self.git('diff-tree', '-r', '-z', '--raw', '--no-renames', before or EMPTY_TREE, after)
+        fields = raw.split(b'\0')
+        differences = []
+        for header, path in zip(fields[0::2], fields[1::2]):
+            if not header.startswith(b':'):
+                continue
+            before_mode, after_mode, before_blob, after_blob, change_type = header[1:].decode().split(' ')
+            path = path.decode()
+            difference = {'changeType': change_type}
+            if change_type != 'A':
+                difference['beforeBlob'] = {'blobId': before_blob, 'path': path, 'mode': before_mode}
+            if change_type != 'D':
+                difference['afterBlob'] = {'blobId': after_blob, 'path': path, 'mode': after_mode}
+            differences.append(difference)
+        with self._lock:
+            self._diffs[key] = differences
+            while len(self._diffs) > self._cached_diffs:
+                self._diffs.popitem(last=False)
+        return differences
+
+    def get_file(self, repositoryName, commitSpecifier, filePath, **kwargs):
+        self.calls('codecommit:GetFile')
+        commit_id = self.resolve_commit(commitSpecifier)
+        try:
+            blob_id = self.git('rev-parse', '--verify', '--quiet', f'{commit_id}:{filePath}').decode().strip()
+        except subprocess.CalledProcessError:
+            raise self.exceptions.FileDoesNotExistException(filePath)
+        return {'commitId': commit_id, 'blobId': blob_id, 'filePath': filePath,
+                'fileContent': self.git('cat-file', 'blob', blob_id)}
+
+    def get_blob(self, repositoryName, blobId, **kwargs):
+        self.calls('codecommit:GetBlob')
+        try:
+            return {'content': self.git('cat-file', 'blob', blobId)}
+        except subprocess.CalledProcessError:
+            raise self.exceptions.BlobIdDoesNotExistException(blobId)
+
+    def get_branch(self, repositoryName, branchName, **kwargs):
+        self.calls('codecommit:GetBranch')
+        try:
+            commit_id = self.git('rev-parse', '--verify', '--quiet', f'refs/heads/{branchName}').decode().strip()
+        except subprocess.CalledProcessError:
+            raise self.exceptions.BranchDoesNotExistException(branchName)
+        return {'branch': {'branchName': branchName, 'commitId': commit_id}}
+
+    def get_commit(self, repositoryName, commitId, **kwargs):
+        self.calls('codecommit:GetCommit')
+        commit_id = self.resolve_commit(commitId)
+        tree_id, parents, message = self.git('show', '-s', '--format=%T%n%P%n%B', commit_id).decode().split('\n', 2)
+        return {'commit': {'commitId': commit_id, 'treeId': tree_id, 'parents': parents.split(),
+                           'message': message.strip()}}
+
+
+class LocalAws:
+    """
+    The three emulated services over one repository, sharing one API call counter
+    """
+
+    def __init__(self, repo_path, pipeline_names=None, latency_ms=0.0, execution_seconds=0.0, throttle_rate=0.0):
+        self.repo_path = repo_path
+        self.calls = ApiCounter(latency_ms)
+        self.codecommit = LocalCodeCommit(repo_path, self.calls)
+        self.ssm = LocalSsm(self.calls)
+        self.codepipeline = LocalCodePipeline(pipeline_names, self.calls, self.codecommit,
+                                              execution_seconds=execution_seconds, throttle_rate=throttle_rate)
+
+    def install(self, handler):
+        """
+        Makes the handler module use the emulated clients and an SSM last commit store over them
+        """
+        handler._clients.update(codecommit=self.codecommit, ssm=self.ssm, codepipeline=self.codepipeline)
+        handler.last_commit_store = handler.SsmLastCommitStore(self.ssm)
+        handler._pipeline_router_cache.clear()
+
+    def push_event(self, *branches, repository=REPOSITORY):
+        """
+        CodeCommit trigger event updating the branches to their current head
+        """
+        return {'Records': [{
+            'eventSourceARN': f'arn:aws:codecommit:us-east-1:123456789012:{repository}',
+            'codecommit': {'references': [{'commit': self.codecommit.resolve_commit(branch),
+                                           'ref': f'refs/heads/{branch}'} for branch in branches]}}]}
+
+
+def service_dir(index):
+    return f'service{index:03d}'
+
+
+def pipeline_name(index, branch='main'):
+    return f"codepipeline-service{index:03d}-{branch.replace('/', '-')}"
+
+
+def init_repository(repo_path):
+    if not os.path.exists(os.path.join(repo_path, 'HEAD')) and not os.path.exists(os.path.join(repo_path, '.git')):
+        subprocess.run(['git', 'init', '--bare', '--quiet', repo_path], check=True)
+
+
+def generate_history(repo_path, branch='main', base=None, services=50, commits=100, files_per_commit=20,
+                     files_per_service=20, seed=0):
+    """
+    Appends `commits` commits to branch (created from base, another branch or commit, when missing) with
+    git fast-import. The first commit of a new branch adds its monorepo-{branch}.json map (and files_per_service
+    files to each service in an empty repository), each following commit modifies, adds or deletes
+    files_per_commit files of random services. Returns the ids of the new commits, oldest first.
+    """
+    init_repository(repo_path)
+    rng = random.Random(f'{seed}/{branch}')
+    codecommit = LocalCodeCommit(repo_path)
+    try:
+        parent = codecommit.resolve_commit(branch)
+    except LocalCodeCommit.exceptions.CommitDoesNotExistException:
+        parent = codecommit.resolve_commit(base) if base else None
+    existing = set()
+    if parent:
+        existing.update(codecommit.git('ls-tree', '-r', '--name-only', '-z', parent).decode().split('\0'))
+        existing.discard('')
+    files = sorted(existing)
+    clock = int(time.time()) - commits
+
+    def commit_block(mark, message, changes):
+        lines = [f'commit refs/heads/{branch}', f'mark :{mark}',
+                 f'committer Emulator <emulator@example.com> {clock + mark} +0000']
+        body = message.encode()
+        stream = ['\n'.join(lines).encode(), f'\ndata {len(body)}\n'.encode(), body, b'\n']
+        if mark > 1:
+            stream.append(f'from :{mark - 1}\n'.encode())
+        elif parent:
+            stream.append(f'from {parent}\n'.encode())
+        for path, content in changes:
+            if content is None:
+                stream.append(f'D {path}\n'.encode())
+            else:
+                stream.append(f'M 100644 inline {path}\ndata {len(content)}\n'.encode())
+                stream.extend([content, b'\n'])
+        stream.append(b'\n')
+        return b''.join(stream)
+
+    def content(path):
+        return f'{path} {rng.getrandbits(64):016x}\n'.encode()
+
+    stream = []
+    mark = 1
+    map_path = f"monorepo-{branch.replace('/', '-')}.json"
+    if map_path not in existing:
+        pipeline_map = {service_dir(index): pipeline_name(index, branch) for index in range(services)}
+        changes = [(map_path, json.dumps(pipeline_map, indent=4).encode())]
+        if not files:
+            for index in range(services):
+                for number in range(files_per_service):
+                    path = f'{service_dir(index)}/src/module{number % 7}/file{number}.py'
+                    changes.append((path, content(path)))
+            files = sorted(path for path, _ in changes if path != map_path)
+        stream.append(commit_block(mark, f'add {map_path}', changes))
+        mark += 1
+        commits -= 1
+    service_files = [path for path in files if '/' in path]
+    for _ in range(commits):
+        changes = []
+        for _ in range(files_per_commit):
+            roll = rng.random()
+            if roll < 0.1 or not service_files:
+                path = f'{service_dir(rng.randrange(services))}/src/new/file{rng.getrandbits(32):08x}.py'
+                service_files.append(path)
+                changes.append((path, content(path)))
+            elif roll < 0.15 and len(service_files) > 1:
+                path = service_files.pop(rng.randrange(len(service_files)))
+                changes.append((path, None))
+            else:
+                path = rng.choice(service_files)
+                changes.append((path, content(path)))
+        changes = list(dict(changes).items())
+        stream.append(commit_block(mark, f'commit {mark}', changes))
+        mark += 1
+
+    subprocess.run(['git', '-C', repo_path, 'fast-import', '--quiet', '--force'], input=b''.join(stream), check=True)
+    revisions = f'{parent}..{branch}' if parent else branch
+    return codecommit.git('rev-list', '--reverse', '--first-parent', revisions).decode().split()
+
+
+def replay(args):
+    """
+    Replays pushes of each branch through handler.main (or enqueue/consume) and returns a summary
+    """
+    sys.path.insert(0, os.path.join(ROOT_DIR, 'core', 'lambda'))
+    import handler
+    from tools.local_fifo_queue import LocalFifoQueue
+
+    branches = ['main'] + [f'feature/{index}' for index in range(1, args.branches)]
+    generate_history(args.repo, 'main', services=args.services, commits=1, files_per_service=args.files_per_service,
+                     seed=args.seed)
+    aws = LocalAws(args.repo, latency_ms=args.latency_ms, execution_seconds=args.execution_seconds,
+                   throttle_rate=args.throttle_rate)
+    aws.install(handler)
+    handler.TRIGGER_BRANCH_PATTERNS = ['*']
+    for branch in branches:
+        aws.ssm.put_parameter(Name=handler.build_parameter_name(REPOSITORY, branch),
+                              Value=aws.codecommit.resolve_commit('main'))
+    queue = None
+    if args.queue:
+        queue = LocalFifoQueue()
+        handler._clients['sqs'] = queue
+
+    commits_per_push = max(1, args.commits // args.pushes)
+    started_at = time.perf_counter()
+    latencies = []
+    for push in range(args.pushes):
+        for branch in branches:
+            generate_history(args.repo, branch, base='main', services=args.services, commits=commits_per_push,
+                             files_per_commit=args.files_per_commit, seed=f'{args.seed}/{push}')
+        event = aws.push_event(*branches)
+        push_started_at = time.perf_counter()
+        if queue is not None:
+            handler.enqueue(event, None)
+            queue.drain(handler.consume, pollers=args.pollers)
+        else:
+            handler.main(event, None)
+        latencies.append((time.perf_counter() - push_started_at) * 1000)
+
+    latencies.sort()
+    return {
+        'branches': len(branches),
+        'pushes': args.pushes,
+        'commits_per_push': commits_per_push,
+        'total_s': round(time.perf_counter() - started_at, 2),
+        'push_ms_p50': round(latencies[len(latencies) // 2], 1),
+        'push_ms_max': round(latencies[-1], 1),
+        'pipelines_started': len(aws.codepipeline.started()),
+        'dead_letters': len(queue.dead_letters) if queue is not None else 0,
+        'api_calls': aws.calls.counts,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repo', required=True, help='git repository to create or extend')
+    parser.add_argument('--services', type=int, default=50)
+    parser.add_argument('--files-per-service', type=int, default=20)
+    parser.add_argument('--commits', type=int, default=100, help='commits generated per branch')
+    parser.add_argument('--files-per-commit', type=int, default=20)
+    parser.add_argument('--branches', type=int, default=1, help="'main' and branches feature/1 ...")
+    parser.add_argument('--pushes', type=int, default=10, help='pushes per branch, the commits are spread over them')
+    parser.add_argument('--queue', action='store_true', help='go through enqueue, the local FIFO queue and consume')
+    parser.add_argument('--pollers', type=int, default=4, help='concurrent queue pollers (with --queue)')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='latency injected in every API call')
+    parser.add_argument('--execution-seconds', type=float, default=0.0, help='duration of the pipeline executions')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of throttled pipeline starts')
+    parser.add_argument('--seed', default='0')
+    args = parser.parse_args(argv)
+
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            summary = replay(args)
+        finally:
+            sys.stdout = stdout
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+In-process stand-in for the SQS FIFO queue in front of the trigger lambda, to exercise the ordering layer offline.
+
+    queue = LocalFifoQueue()
+    handler._clients['sqs'] = queue
+    handler.enqueue(codecommit_event, None)
+    queue.drain(handler.consume, pollers=4)
+
+It keeps the SQS FIFO guarantees the handler relies on: messages are deduplicated by MessageDeduplicationId,
+a message group is never delivered to two consumers at the same time, messages of a group are delivered in order,
+and failed messages (partial batch response) go back to the head of their group until max_receive_count.
+change_message_visibility_batch hides the messages of a group (delayed groups are delivered again later).
+"""
+from collections import OrderedDict, deque
+import itertools
+import threading
+import time
+
+
+class LocalFifoQueue:
+
+    def __init__(self, batch_size=10, max_receive_count=5):
+        self.batch_size = batch_size
+        self.max_receive_count = max_receive_count
+        self.dead_letters = []
+        self._groups = OrderedDict()
+        self._in_flight_groups = set()
+        self._deduplication_ids = set()
+        self._message_ids = itertools.count(1)
+        self._condition = threading.Condition()
+
+    def send_message_batch(self, QueueUrl=None, Entries=()):
+        """
+        Same request and response shape as the boto3 SQS client
+        """
+        successful = []
+        with self._condition:
+            for entry in Entries:
+                message_id = str(next(self._message_ids))
+                successful.append({'Id': entry['Id'], 'MessageId': message_id})
+                if entry['MessageDeduplicationId'] in self._deduplication_ids:
+                    continue
+                self._deduplication_ids.add(entry['MessageDeduplicationId'])
+                self._groups.setdefault(entry['MessageGroupId'], deque()).append({
+                    'messageId': message_id,
+                    'body': entry['MessageBody'],
+                    'receiptHandle': message_id,
+                    'attributes': {'MessageGroupId': entry['MessageGroupId'], 'ApproximateReceiveCount': '0',
+                                   'SentTimestamp': str(int(time.time() * 1000))},
+                    'eventSource': 'aws:sqs',
+                    'visible_at': 0.0})
+            self._condition.notify_all()
+        return {'Successful': successful, 'Failed': []}
+
+    def change_message_visibility_batch(self, QueueUrl=None, Entries=()):
+        """
+        Same request and response shape as the boto3 SQS client
+        """
+        with self._condition:
+            visible_at = {entry['ReceiptHandle']: time.monotonic() + entry['VisibilityTimeout'] for entry in Entries}
+            for messages in self._groups.values():
+                for message in messages:
+                    if message['receiptHandle'] in visible_at:
+                        message['visible_at'] = visible_at[message['receiptHandle']]
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def pending(self):
+        with self._condition:
+            return sum(len(messages) for messages in self._groups.values())
+
+    def receive(self):
+        """
+        Returns an SQS event with up to batch_size messages, taken from groups that are not in flight
+        """
+        records = []
+        with self._condition:
+            for group_id, messages in self._groups.items():
+                if group_id in self._in_flight_groups or not messages or messages[0]['visible_at'] > time.monotonic():
+                    continue
+                self._in_flight_groups.add(group_id)
+                for message in itertools.islice(messages, self.batch_size - len(records)):
+                    message['attributes']['ApproximateReceiveCount'] = \
+                        str(int(message['attributes']['ApproximateReceiveCount']) + 1)
+                    records.append(message)
+                if len(records) >= self.batch_size:
+                    break
+        return {'Records': records}
+
+    def complete(self, event, response):
+        """
+        Deletes the delivered messages, except the ones reported in the partial batch response
+        """
+        failed_ids = {failure['itemIdentifier'] for failure in (response or {}).get('batchItemFailures', ())}
+        with self._condition:
+            for record in event['Records']:
+                group_id = record['attributes']['MessageGroupId']
+                messages = self._groups[group_id]
+                if record['messageId'] not in failed_ids:
+                    messages.remove(record)
+                elif int(record['attributes']['ApproximateReceiveCount']) >= self.max_receive_count:
+                    messages.remove(record)
+                    self.dead_letters.append(record)
+                self._in_flight_groups.discard(group_id)
+            for group_id in [group_id for group_id, messages in self._groups.items() if not messages]:
+                del self._groups[group_id]
+            self._condition.notify_all()
+
+    def drain(self, consumer, pollers=1):
+        """
+        Delivers batches to consumer(event, context) from several concurrent pollers until the queue is empty
+        """
+        def poll():
+            while True:
+                with self._condition:
+                    while self._groups and all(group_id in self._in_flight_groups for group_id in self._groups):
+                        self._condition.wait()
+                    if not self._groups:
+                        return
+                event = self.receive()
+                if not event['Records']:
+                    # Only delayed groups are left
+                    with self._condition:
+                        self._condition.wait(0.05)
+                    continue
+                try:
+                    response = consumer(event, None)
+                except Exception:
+                    response = {'batchItemFailures': [{'itemIdentifier': record['messageId']}
+                                                      for record in event['Records']]}
+                self.complete(event, response)
+
+        threads = [threading.Thread(target=poll) for _ in range(pollers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()